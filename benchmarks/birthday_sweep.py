@@ -0,0 +1,101 @@
+"""
+Benchmark for finding the birthdays to alert in a poll of the birthday system.
+
+Creates throwaway guilds with random alert times and members with random birthdays in the database pointed to by
+DATABASE_URL, then times a day's worth of 20 minute slots, each one a single query (DB.fetch_birthdays) for the guilds
+whose alert falls in it, against the old approach of one members query per guild in the window. The throwaway rows are
+removed afterwards.
+
+Run `python launcher.py db init` first so the server_members_birthday index exists.
+
+Usage:
+    python -m benchmarks.birthday_sweep [guilds] [members] [--legacy]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import datetime
+import asyncpg
+from util.db import DB
+
+# Negative ids so they can never collide with real discord guilds
+FIRST_GUILD_ID = -1000000
+
+WINDOW_MINUTES = 20
+
+LEGACY_GUILDS_QUERY = "SELECT id, bdayalert, bdayalerttime FROM guilds WHERE bdayalerttime < $1 AND bdayalerttime >= $2"
+LEGACY_MEMBERS_QUERY = "SELECT memberid, birthday FROM server_members WHERE DATE_PART('day', birthday) = DATE_PART('day', $2::date) " \
+                       "AND DATE_PART('month', birthday) = DATE_PART('month', $2::date) AND guildid = $1"
+
+
+def windows_of(day: datetime.date):
+    start = datetime.datetime.combine(day, datetime.time.min)
+    for i in range(24 * 60 // WINDOW_MINUTES):
+        begin = start + datetime.timedelta(minutes=i * WINDOW_MINUTES)
+        end = begin + datetime.timedelta(minutes=WINDOW_MINUTES)
+        yield day, begin.time(), end.time() if end.date() == day else datetime.time.max
+
+
+async def legacy_sweep(conn, day, start, stop):
+    found = 0
+    async with conn.transaction():
+        async for guild in conn.cursor(LEGACY_GUILDS_QUERY, stop, start):
+            async for _ in conn.cursor(LEGACY_MEMBERS_QUERY, guild.get('id'), day):
+                found += 1
+    return found
+
+
+async def main(guilds: int, members: int, legacy: bool):
+    pool = await asyncpg.create_pool(os.environ['DATABASE_URL'], max_size=4)
+    db = DB(pool)
+    guild_ids = list(range(FIRST_GUILD_ID - guilds + 1, FIRST_GUILD_ID + 1))
+    try:
+        async with pool.acquire() as conn:
+            await conn.copy_records_to_table(
+                'guilds', columns=['id', 'bdayalert', 'bdayalerttime'],
+                records=[(g, 1, datetime.time(random.randrange(24), random.randrange(60))) for g in guild_ids])
+            birthdays = [datetime.date(2000, 1, 1) + datetime.timedelta(days=d) for d in range(366)]
+            batch = 500000
+            for first in range(0, members, batch):
+                await conn.copy_records_to_table(
+                    'server_members', columns=['guildid', 'memberid', 'level', 'exp', 'boost', 'birthday'],
+                    records=[(guild_ids[i % guilds], i, 0, 0, 1, random.choice(birthdays))
+                             for i in range(first, min(first + batch, members))])
+            await conn.execute("ANALYZE guilds")
+            await conn.execute("ANALYZE server_members")
+        print(f"created {guilds} guilds and {members} members")
+
+        day = datetime.date(2021, 6, 15)
+        windows = list(windows_of(day))
+
+        start = time.perf_counter()
+        # Guilds are all UTC here, so a guild's slot is just its alert time
+        timeline = {}
+        for guild in await db.fetch_alert_guilds():
+            alert = guild.get('bdayalerttime')
+            timeline.setdefault((alert.hour * 60 + alert.minute) // WINDOW_MINUTES, []).append(guild.get('id'))
+        found = 0
+        for slot in range(len(windows)):
+            found += len(await db.fetch_birthdays([(g, day) for g in timeline.get(slot, ())]))
+        print(f"slot queries, {len(windows)} slots: {time.perf_counter() - start:.3f}s ({found} birthdays)")
+
+        if legacy:
+            start = time.perf_counter()
+            found = 0
+            async with pool.acquire() as conn:
+                for window in windows:
+                    found += await legacy_sweep(conn, *window)
+            print(f"per guild queries, {len(windows)} windows: {time.perf_counter() - start:.3f}s ({found} birthdays)")
+    finally:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM guilds WHERE id = ANY($1::bigint[])", guild_ids)
+        await pool.close()
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    asyncio.get_event_loop().run_until_complete(main(int(args[0]) if args else 50000,
+                                                     int(args[1]) if len(args) > 1 else 5000000,
+                                                     '--legacy' in sys.argv))
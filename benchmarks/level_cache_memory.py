@@ -0,0 +1,56 @@
+"""
+Benchmark for the memory used by the level system cache.
+
+Fills the old dict per member layout and util.LevelCache with the same members and reports how much memory each one
+allocated, measured with tracemalloc. Doesn't need a database.
+
+Usage:
+    python -m benchmarks.level_cache_memory [members] [guilds]
+"""
+import sys
+import random
+import tracemalloc
+from util.levelcache import LevelCache
+
+# Discord snowflakes are around this big, which matters since small ints are shared by the interpreter
+SNOWFLAKE_BASE = 700000000000000000
+
+
+def generate(count: int, guilds: int):
+    guild_ids = [SNOWFLAKE_BASE + random.getrandbits(40) for _ in range(guilds)]
+    return [(guild_ids[i % guilds], SNOWFLAKE_BASE + random.getrandbits(48), random.randint(0, 100),
+             random.randint(0, 250000), 1) for i in range(count)]
+
+
+def fill_dicts(members):
+    cache = {}
+    for guild_id, member_id, level, exp, boost in members:
+        cache.setdefault(guild_id, {})[member_id] = {'id': member_id, 'level': level, 'exp': exp, 'boost': boost}
+    return cache
+
+
+def fill_level_cache(members):
+    cache = LevelCache(len(members), 3600)
+    for guild_id, member_id, level, exp, boost in members:
+        cache.put(guild_id, member_id, level, exp, boost)
+    return cache
+
+
+def measure(fill, members):
+    tracemalloc.start()
+    cache = fill(members)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del cache
+    return size
+
+
+def main(count: int, guilds: int):
+    members = generate(count, guilds)
+    for name, fill in (('dict per member', fill_dicts), ('LevelCache columns', fill_level_cache)):
+        size = measure(fill, members)
+        print(f"{name}: {size / 2 ** 20:.1f} MiB for {count} members, {size / count:.0f} bytes per member")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000, int(sys.argv[2]) if len(sys.argv) > 2 else 1000)
@@ -0,0 +1,56 @@
+"""
+Benchmark for flushing dirty level system members into the database.
+
+Creates a throwaway guild with a number of members in the database pointed to by DATABASE_URL, then times the batched
+flush (DB.update_members) against the old one UPDATE per member approach. The throwaway guild is removed afterwards.
+
+Usage:
+    python -m benchmarks.level_flush [members] [--legacy]
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import asyncpg
+from util.db import DB
+
+# Negative id so it can never collide with a real discord guild
+BENCH_GUILD_ID = -1
+
+
+async def legacy_flush(pool, records):
+    for guildid, memberid, level, exp, boost in records:
+        await pool.execute("UPDATE server_members SET level = $1, exp = $2, boost = $3 "
+                           "WHERE memberid = $4 AND guildid = $5",
+                           level, exp, boost, memberid, guildid)
+
+
+async def main(count: int, legacy: bool):
+    pool = await asyncpg.create_pool(os.environ['DATABASE_URL'], max_size=20)
+    db = DB(pool)
+    try:
+        await db.make_guild_entry(BENCH_GUILD_ID)
+        async with pool.acquire() as conn:
+            await conn.copy_records_to_table('server_members',
+                                             records=[(BENCH_GUILD_ID, i, 0, 0, 1) for i in range(count)],
+                                             columns=['guildid', 'memberid', 'level', 'exp', 'boost'])
+
+        records = [(BENCH_GUILD_ID, i, random.randint(0, 100), random.randint(0, 250000), 1) for i in range(count)]
+
+        start = time.perf_counter()
+        await db.update_members(records)
+        print(f"batched flush of {count} members: {time.perf_counter() - start:.3f}s")
+
+        if legacy:
+            start = time.perf_counter()
+            await legacy_flush(pool, records)
+            print(f"per member flush of {count} members: {time.perf_counter() - start:.3f}s")
+    finally:
+        await db.remove_guild_entry(BENCH_GUILD_ID)
+        await pool.close()
+
+
+if __name__ == '__main__':
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    asyncio.get_event_loop().run_until_complete(main(int(args[0]) if args else 100000, '--legacy' in sys.argv))
@@ -0,0 +1,226 @@
+import json
+import time
+import util
+import asyncio
+import discord
+from main import Zeta
+from discord.ext import commands, tasks
+
+# Defaults for guilds that haven't configured anti spam themselves
+DEFAULT_SETTINGS = {
+    # A member sending this many messages within this many seconds is spamming
+    'member': [6, 5],
+    # This many messages within this many seconds in one channel is a flood, usually a raid
+    'channel': [25, 5],
+    # What happens to spammers, 'mute' or 'warn'
+    'action': 'mute',
+    # Minutes spammers get muted for
+    'mute_minutes': 10,
+}
+
+# Seconds of slowmode a flooded channel is put in, and for how many minutes
+FLOOD_SLOWMODE_SECONDS = 10
+FLOOD_SLOWMODE_MINUTES = 5
+
+# Windows that haven't seen a message in this many minutes get dropped
+WINDOW_IDLE_MINUTES = 10
+
+
+class AntiSpam(commands.Cog):
+    """
+    Automatically deals with members spamming messages and channels getting flooded
+    """
+    def __init__(self, bot: Zeta):
+        self.bot = bot
+
+        # guildid -> {memberid: util.SlidingWindow}
+        self._members = {}
+
+        # channelid -> util.SlidingWindow
+        self._channels = {}
+
+        # Channels currently in flood slowmode
+        self._slowed = set()
+
+        self.drop_idle_windows.start()
+
+    def cog_unload(self):
+        self.drop_idle_windows.cancel()
+
+    async def cog_check(self, ctx: commands.Context):
+        try:
+            return self.bot.guild_prefs[ctx.guild.id]['antispam']
+        except KeyError:
+            return False
+
+    async def cog_command_error(self, ctx, error):
+        if isinstance(error, commands.CheckFailure):
+            if ctx.guild.id not in self.bot.guild_prefs:
+                cg = self.bot.get_cog('Configuration')
+                await cg.create_default_guild_prefs(ctx.guild.id)
+            if not self.bot.guild_prefs[ctx.guild.id].get('antispam'):
+                await ctx.send("The `antispam` plugin has been disabled on this server therefore related commands will not work\n"
+                               "Hint: Server admins can enable it using the `plugin enable` command, use the help command to learn more.")
+
+    def settings_for(self, guild_id: int) -> dict:
+        """Returns the anti spam settings of a guild, defaults filled in"""
+        return {**DEFAULT_SETTINGS, **(self.bot.guild_prefs[guild_id].get('antispamsettings') or {})}
+
+    async def save_settings(self, guild_id: int, **changes) -> None:
+        """Changes some anti spam settings of a guild, windows of the guild are dropped so they pick the new ones up"""
+        prefs = self.bot.guild_prefs[guild_id]
+        prefs['antispamsettings'] = {**(prefs.get('antispamsettings') or {}), **changes}
+        await self.bot.pool.execute("UPDATE guilds SET preferences = $1 WHERE id = $2", json.dumps(prefs), guild_id)
+        self._members.pop(guild_id, None)
+        guild = self.bot.get_guild(guild_id)
+        for channel in guild.channels if guild else ():
+            self._channels.pop(channel.id, None)
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message) -> None:
+        """
+        Counts the message in the windows of its author and channel, anything more than that only happens once one of
+        them overflows
+        """
+        if message.guild is None or message.author.bot:
+            return
+        prefs = self.bot.guild_prefs.get(message.guild.id)
+        if not prefs or not prefs.get('antispam'):
+            return
+
+        now = time.monotonic()
+        members = self._members.setdefault(message.guild.id, {})
+        window = members.get(message.author.id)
+        if window is None:
+            window = members[message.author.id] = util.SlidingWindow(*self.settings_for(message.guild.id)['member'])
+        channel_window = self._channels.get(message.channel.id)
+        if channel_window is None:
+            channel_window = self._channels[message.channel.id] = util.SlidingWindow(*self.settings_for(message.guild.id)['channel'])
+
+        if window.hit(now):
+            # Starting over, so the same burst doesn't get punished for every message after the limit
+            window.clear()
+            await self.punish(message)
+        if channel_window.hit(now):
+            channel_window.clear()
+            # Runs for the whole slowmode, no point holding up this listener for it
+            self.bot.loop.create_task(self.slow_down(message.channel))
+
+    async def punish(self, message: discord.Message) -> None:
+        """Mutes or warns the author of a spam message, as the guild's settings say"""
+        member = message.author
+        # Moderators are trusted to know what they're doing
+        if message.channel.permissions_for(member).manage_messages:
+            return
+        moderation = self.bot.get_cog('Moderation')
+        settings = self.settings_for(message.guild.id)
+        count, seconds = settings['member']
+        reason = f"Automatic: sent {count} messages within {seconds} seconds"
+        try:
+            if settings['action'] == 'warn':
+                await moderation.warn_member(member, reason)
+                await message.channel.send(embed=discord.Embed(description=f"{member.mention} was warned for spamming",
+                                                               colour=discord.Colour.red()))
+            else:
+                await moderation.mute_member(member, settings['mute_minutes'], reason)
+                await message.channel.send(embed=discord.Embed(
+                    description=f"{member.mention} has been muted for {settings['mute_minutes']} minutes for spamming",
+                    colour=discord.Colour.red()))
+        except discord.Forbidden:
+            pass
+
+    async def slow_down(self, channel: discord.TextChannel) -> None:
+        """Puts a flooded channel in slowmode for a while, unless it's already in slowmode"""
+        if channel.id in self._slowed or channel.slowmode_delay:
+            return
+        self._slowed.add(channel.id)
+        try:
+            await channel.edit(slowmode_delay=FLOOD_SLOWMODE_SECONDS, reason="Automatic: channel flooded")
+            await channel.send(embed=discord.Embed(
+                description=f"This channel is being flooded, slowmode is on for the next {FLOOD_SLOWMODE_MINUTES} minutes",
+                colour=discord.Colour.red()))
+            await asyncio.sleep(FLOOD_SLOWMODE_MINUTES * 60)
+            await channel.edit(slowmode_delay=0, reason="Automatic: flood slowmode over")
+        except discord.HTTPException:
+            pass
+        finally:
+            self._slowed.discard(channel.id)
+
+    @tasks.loop(minutes=WINDOW_IDLE_MINUTES)
+    async def drop_idle_windows(self):
+        """Drops the windows of members and channels that have gone quiet, they start out empty again if they don't"""
+        idle_since = time.monotonic() - WINDOW_IDLE_MINUTES * 60
+        for guild_id, members in list(self._members.items()):
+            for member_id in [m for m, w in members.items() if w.last < idle_since]:
+                del members[member_id]
+            if not members:
+                del self._members[guild_id]
+        for channel_id in [c for c, w in self._channels.items() if w.last < idle_since]:
+            del self._channels[channel_id]
+
+    @commands.group(invoke_without_command=True)
+    @commands.has_guild_permissions(manage_guild=True)
+    async def antispam(self, ctx: commands.Context):
+        """
+        Shows the anti spam settings of this server
+
+        Use the subcommands `member`, `channel` and `action` to change them.
+        Note that you need to have the server permission "Manage server" to use this command
+        """
+        settings = self.settings_for(ctx.guild.id)
+        e = discord.Embed(title="Anti spam settings", colour=discord.Colour.green())
+        e.add_field(name="Member limit", value=f"{settings['member'][0]} messages in {settings['member'][1]} seconds")
+        e.add_field(name="Channel limit", value=f"{settings['channel'][0]} messages in {settings['channel'][1]} seconds")
+        action = f"mute for {settings['mute_minutes']} minutes" if settings['action'] == 'mute' else 'warn'
+        e.add_field(name="Spammers get", value=action)
+        await ctx.send(embed=e)
+
+    @antispam.command(name='member')
+    @commands.has_guild_permissions(manage_guild=True)
+    async def antispam_member(self, ctx: commands.Context, count: int, seconds: int):
+        """
+        Sets how many messages a member can send within some seconds before they're considered spamming
+
+        For example `antispam member 6 5` lets members send up to 5 messages within 5 seconds.
+        """
+        if count < 2 or seconds < 1:
+            return await ctx.send("`count` has to be at least 2 and `seconds` at least 1")
+        await self.save_settings(ctx.guild.id, member=[count, seconds])
+        await ctx.send(embed=discord.Embed(title="Success", description=f"Members sending {count} messages within {seconds} seconds will be dealt with",
+                                           colour=discord.Colour.green()))
+
+    @antispam.command(name='channel')
+    @commands.has_guild_permissions(manage_guild=True)
+    async def antispam_channel(self, ctx: commands.Context, count: int, seconds: int):
+        """
+        Sets how many messages can be sent in a channel within some seconds before it's put in slowmode for a while
+        """
+        if count < 2 or seconds < 1:
+            return await ctx.send("`count` has to be at least 2 and `seconds` at least 1")
+        await self.save_settings(ctx.guild.id, channel=[count, seconds])
+        await ctx.send(embed=discord.Embed(title="Success", description=f"Channels getting {count} messages within {seconds} seconds will be slowed down",
+                                           colour=discord.Colour.green()))
+
+    @antispam.command(name='action')
+    @commands.has_guild_permissions(manage_guild=True)
+    async def antispam_action(self, ctx: commands.Context, action: str, minutes: int = None):
+        """
+        Sets what happens to spammers
+
+        `action` here is either `mute` or `warn`, `minutes` (optional) is how long spammers get muted for when it's `mute`.
+        """
+        action = action.lower()
+        if action not in ('mute', 'warn'):
+            return await ctx.send("Invalid action, use `mute` or `warn`")
+        changes = {'action': action}
+        if minutes is not None:
+            if minutes < 1:
+                return await ctx.send("`minutes` has to be at least 1")
+            changes['mute_minutes'] = minutes
+        await self.save_settings(ctx.guild.id, **changes)
+        await ctx.send(embed=discord.Embed(title="Success", description=f"Spammers will now get a {action}",
+                                           colour=discord.Colour.green()))
+
+
+def setup(bot: Zeta):
+    bot.add_cog(AntiSpam(bot))
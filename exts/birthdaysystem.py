@@ -1,7 +1,55 @@
+import util
+import asyncio
 import discord
 import datetime
+import functools
 from main import Zeta
-from discord.ext import commands, tasks
+from discord.ext import commands
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    # Python 3.8, zoneinfo only became part of the standard library in 3.9
+    from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Birthdays listed per page of a birthday announcement
+BIRTHDAYS_PER_PAGE = 10
+
+# Seconds the pages of a birthday announcement can be flipped for
+ANNOUNCEMENT_PAGE_TIMEOUT = 600
+
+# Most birthdays the upcoming command lists
+UPCOMING_MAX = 50
+
+# Sent markers of alerts are kept for this many days, long enough for a restart around midnight to not resend any
+SENT_MARKER_DAYS = 2
+
+
+@functools.lru_cache(maxsize=None)
+def zone(name: str = None) -> datetime.tzinfo:
+    """Returns the timezone with an IANA name (like Europe/Berlin), UTC for None, raises ValueError for unknown names"""
+    if name is None:
+        return datetime.timezone.utc
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"{name} isn't a known timezone")
+
+
+def next_occurrence(birthday: datetime.date, today: datetime.date) -> datetime.date:
+    """Returns the date a birthday is celebrated on next, today included, the 29th of February is the 1st of March in
+    years that don't have it"""
+    for year in (today.year, today.year + 1):
+        try:
+            day = birthday.replace(year=year)
+        except ValueError:
+            day = datetime.date(year, 3, 1)
+        if day >= today:
+            return day
+
+
+def fire_instant(day: datetime.date, alert_time: datetime.time, tz: datetime.tzinfo) -> datetime.datetime:
+    """Returns when (naive UTC) an alert set for a local time in a timezone goes out on a local day"""
+    return datetime.datetime.combine(day, alert_time, tzinfo=tz).astimezone(datetime.timezone.utc).replace(tzinfo=None)
 
 
 class BirthdaySystem(commands.Cog, name="Birthday system"):
@@ -10,7 +58,24 @@ class BirthdaySystem(commands.Cog, name="Birthday system"):
     """
     def __init__(self, bot: Zeta):
         self.bot = bot
-        self.bday_poll.start()
+
+        # Timeline of guilds by UTC time of their next alert: guildid -> fire time, payload being
+        # (alert channel id, alert time, timezone name, local day the alert is for)
+        self._timeline = util.TimerHeap()
+        self._timeline_changed = asyncio.Event()
+        self._loaded = False
+        # UTC day sent markers were last cleaned up on
+        self._cleaned = None
+        # guildid -> timezone name, for guilds that set one, loaded along with the calendar
+        self._timezones = {}
+
+        self.calendar = util.BirthdayCalendar()
+        self._calendar_loaded = asyncio.Event()
+        self.bot.loop.create_task(self.load_calendar())
+        self._alert_task = self.bot.loop.create_task(self.alert_loop())
+
+    def cog_unload(self):
+        self._alert_task.cancel()
 
     async def cog_check(self, ctx: commands.Context):
         try:
@@ -26,6 +91,40 @@ class BirthdaySystem(commands.Cog, name="Birthday system"):
                 await ctx.send("The `birthdays` plugin has been disabled on this server therefore related commands will not work\n"
                                "Hint: Server admins can enable it using the `plugin enable` command, use the help command to learn more.")
 
+    async def load_calendar(self):
+        """
+        Loads every birthday into the calendar and every guild's timezone with one query each, setbd and bdtimezone
+        keep them up to date from there on
+        """
+        # bday, setbd and upcoming wait for this, so it keeps trying until it gets through
+        while True:
+            entries = []
+            timezones = {}
+            try:
+                async with self.bot.pool.acquire() as conn:
+                    async with conn.transaction():
+                        async for entry in conn.cursor("SELECT guildid, memberid, birthday FROM server_members WHERE birthday IS NOT NULL"):
+                            entries.append((entry.get('guildid'), entry.get('memberid'), entry.get('birthday')))
+                        async for entry in conn.cursor("SELECT id, timezone FROM guilds WHERE timezone IS NOT NULL"):
+                            timezones[entry.get('id')] = entry.get('timezone')
+                break
+            except Exception as error:
+                print(f"Loading the birthday calendar failed ({error!r}), retrying in 30 seconds")
+                await asyncio.sleep(30)
+        # Timezones set while this was loading are newer
+        self._timezones = {**timezones, **self._timezones}
+        self.calendar.load(entries)
+        self._calendar_loaded.set()
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self.calendar.remove(member.guild.id, member.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: discord.Guild):
+        self.calendar.drop_guild(guild.id)
+        self._timeline.cancel(guild.id)
+
     @commands.command()
     async def bday(self, ctx: commands.Context, target: discord.Member) -> None:
         """
@@ -33,12 +132,12 @@ class BirthdaySystem(commands.Cog, name="Birthday system"):
 
         `target` here is the member whose birthday you wish to see, not that they need to have their birthday saved in this server using the setbd command
         """
-        query = "SELECT birthday FROM server_members WHERE memberid = $1 AND guildid = $2"
-        data = await self.bot.pool.fetchrow(query, target.id, ctx.guild.id)
+        await self._calendar_loaded.wait()
+        birthday = self.calendar.birthday(ctx.guild.id, target.id)
 
         # If birthday existed in db
-        if data.get('birthday'):
-            birthday = data.get('birthday').strftime("%d %B")
+        if birthday:
+            birthday = birthday.strftime("%d %B")
         else:
             # Send error message if birthday wasn't found
             await ctx.send(f"Couldn't find {target}'s birthday in this server, tell them to set it using "
@@ -67,8 +166,11 @@ class BirthdaySystem(commands.Cog, name="Birthday system"):
             return
 
         # Yeet it into dabatase
-        query = f"UPDATE server_members SET birthday=to_date($1, 'DD MM YYYY') WHERE memberid =  $2 AND guildid = $3"
-        await self.bot.pool.execute(query, date_of_birth, ctx.author.id, ctx.guild.id)
+        query = f"UPDATE server_members SET birthday=to_date($1, 'DD MM YYYY') WHERE memberid =  $2 AND guildid = $3 RETURNING birthday"
+        birthday = await self.bot.pool.fetchval(query, date_of_birth, ctx.author.id, ctx.guild.id)
+        await self._calendar_loaded.wait()
+        if birthday is not None:
+            self.calendar.set(ctx.guild.id, ctx.author.id, birthday)
 
         # Send confirmation message stating that the birthday was recorded successfully
         embed = discord.Embed(title="Birthday recorded!",
@@ -76,68 +178,177 @@ class BirthdaySystem(commands.Cog, name="Birthday system"):
                               colour=discord.Colour.green())
         await ctx.send(embed=embed)
 
-    async def send_wish(self, guildid: int, channelid: int, memberid: int, when: datetime.datetime):
-        """
-        Sends a birthday wish in a guild at a specified time in UTC
+        # In case it's today
+        await self.reschedule_guild(ctx.guild.id)
+
+    @commands.command(aliases=['upcomingbirthdays'])
+    async def upcoming(self, ctx: commands.Context, count: int = 10):
         """
-        await discord.utils.sleep_until(when)
+        Lists the members of this server whose birthdays come next, starting with today's
 
+        `count` (optional) is how many birthdays to list, 10 by default and at most 50
+        """
+        await self._calendar_loaded.wait()
+        count = min(max(count, 1), UPCOMING_MAX)
+        today = datetime.datetime.now(zone(self._timezones.get(ctx.guild.id))).date()
+
+        lines = []
+        for memberid, birthday in self.calendar.upcoming(ctx.guild.id, today):
+            if len(lines) == count:
+                break
+            member = ctx.guild.get_member(memberid)
+            # Members that left but whose birthday is still saved are skipped
+            if member is None:
+                continue
+            days = (next_occurrence(birthday, today) - today).days
+            when = "today" if days == 0 else "tomorrow" if days == 1 else f"in {days} days"
+            lines.append(f"**{birthday.strftime('%d %B')}** {member.mention} ({when})")
+
+        if not lines:
+            return await ctx.send(f"Nobody has their birthday saved in this server yet, use `{ctx.prefix}setbd` to save yours")
+        await ctx.send(embed=discord.Embed(title="Upcoming birthdays", description="\n".join(lines),
+                                           colour=discord.Colour.blue()))
+
+    async def send_wishes(self, guildid: int, channelid: int, memberids: list):
+        """
+        Announces everyone having their birthday in a guild at once, as one message whose pages can be flipped through
+        when there's more than a page of them
+        """
         guild = self.bot.get_guild(guildid)
-        channel = guild.get_channel(channelid)
-        m = guild.get_member(memberid)
-        e = discord.Embed(title=f"{m} has their birthday today!",
-                          description=f"Reblog if u eating beans",
-                          colour=discord.Colour.blue())
-
-        await channel.send(embed=e)
-
-    @tasks.loop(minutes=20)
-    async def bday_poll(self):
-        # Future is the time of the next iteration of the loop
-        now = datetime.datetime.utcnow()
-        future = now + datetime.timedelta(minutes=20)
+        channel = guild.get_channel(channelid) if guild else None
+        if channel is None:
+            return
+        members = [m for m in map(guild.get_member, memberids) if m is not None]
+        if not members:
+            return
 
-        # Query the database to find the time at which alert is to be sent out
-        query1 = f"SELECT id, bdayalert, bdayalerttime FROM guilds WHERE bdayalerttime < $1 AND bdayalerttime > $2"
+        pages = []
+        for start in range(0, len(members), BIRTHDAYS_PER_PAGE):
+            e = discord.Embed(title=f"{members[0]} has their birthday today!" if len(members) == 1 else
+                              f"{len(members)} members have their birthday today!",
+                              description="\n".join(m.mention for m in members[start:start + BIRTHDAYS_PER_PAGE]),
+                              colour=discord.Colour.blue())
+            e.set_footer(text="Reblog if u eating beans")
+            pages.append(e)
+        if len(pages) > 1:
+            for number, e in enumerate(pages):
+                e.set_footer(text=f"Page {number + 1}/{len(pages)} \u2022 Reblog if u eating beans")
+
+        async def get_page(number):
+            return pages[number]
+
+        await util.EmbedPaginator(self.bot, channel, get_page, len(pages), timeout=ANNOUNCEMENT_PAGE_TIMEOUT).start()
+
+    def schedule_guild(self, guildid: int, channelid: int, alert_time: datetime.time, timezone: str,
+                       day: datetime.date = None) -> None:
+        """
+        Puts a guild's alert for a local day (today in its timezone if not given) in the timeline, replacing the one it
+        had. Alerts whose time has passed go out right away, the sent markers make sure nobody is alerted twice.
+        """
+        tz = zone(timezone)
+        if timezone is not None:
+            self._timezones[guildid] = timezone
+        if day is None:
+            day = datetime.datetime.now(tz).date()
+        self._timeline.push(guildid, fire_instant(day, alert_time, tz), (channelid, alert_time, timezone, day))
+        self._timeline_changed.set()
+
+    async def load_timeline(self) -> None:
+        """
+        Puts every guild with alerts set up in the timeline, with one query
+        """
+        async with self.bot.scheduler.cycle('birthday timeline'), self.bot.scheduler.connection_slot():
+            guilds = await self.bot.db.fetch_alert_guilds()
+        for record in guilds:
+            try:
+                self.schedule_guild(record.get('id'), record.get('bdayalert'), record.get('bdayalerttime'),
+                                    record.get('timezone'))
+            except ValueError as error:
+                print(f"Couldn't schedule birthday alerts of {record.get('id')}: {error}")
+        self._loaded = True
+
+    async def reschedule_guild(self, guildid: int) -> None:
+        """
+        Puts a single guild in the timeline again, after its alert settings or birthdays changed
+        """
+        if not self._loaded:
+            return
+        self._timeline.cancel(guildid)
+        for record in await self.bot.db.fetch_alert_guilds(guildid):
+            self.schedule_guild(guildid, record.get('bdayalert'), record.get('bdayalerttime'), record.get('timezone'))
 
-        # Query to fetch the members who have their birthday on that day
-        query = "SELECT memberid, birthday FROM server_members WHERE DATE_PART('day', birthday) = DATE_PART('day', CURRENT_DATE) AND DATE_PART('month', birthday) = DATE_PART('month', CURRENT_DATE) AND guildid = $1"
+    async def fire_alerts(self, due) -> None:
+        """
+        Sends the alerts of the guilds that are due, finding their birthdays with one query, every alert is marked sent
+        first so it can't go out twice. The guilds are then put back in the timeline for their next local day.
+        """
+        async with self.bot.scheduler.connection_slot():
+            records = await self.bot.db.fetch_birthdays([(guildid, payload[3]) for guildid, _, payload in due])
+            sent = await self.bot.db.mark_birthdays_sent(
+                [(r.get('guildid'), r.get('memberid'), r.get('day')) for r in records])
+
+        # guildid -> memberids, one announcement each
+        batches = {}
+        for r in sent:
+            if (self.bot.guild_prefs.get(r.get('guildid')) or {}).get('birthdays'):
+                batches.setdefault(r.get('guildid'), []).append(r.get('memberid'))
+
+        for guildid, _, (channelid, alert_time, timezone, day) in due:
+            if guildid in batches:
+                # Flipping pages goes on for a while, so not waited on
+                self.bot.loop.create_task(self.announce(guildid, channelid, batches[guildid]))
+            if guildid not in self._timeline:
+                self.schedule_guild(guildid, channelid, alert_time, timezone, day + datetime.timedelta(days=1))
+
+    async def announce(self, guildid: int, channelid: int, memberids: list) -> None:
+        try:
+            await self.send_wishes(guildid, channelid, memberids)
+        except discord.HTTPException as error:
+            print(f"Couldn't send a birthday alert in {guildid}: {error!r}")
 
-        async with self.bot.pool.acquire() as conn:
-            async with conn.transaction():
-                async for guild_record in conn.cursor(query1, future, now):
-
-                    # Converting alert time to string here as it needs to be merged with the whole
-                    # date to make it datetime instead of just time
-                    alert_time = guild_record.get('bdayalerttime').strftime("%H %M %S")
-                    temp_time_str = datetime.datetime.utcnow().strftime('%d %m %y')
-
-                    # Alert time is converted into datetime object with date of today
-                    new_time = datetime.datetime.strptime(f"{temp_time_str} {alert_time}", "%d %m %y %H %M %S")
-
-                    # Get the channel id in which to send alerts
-                    alert_channel_id = guild_record.get('bdayalert')
-
-                    # If an alert time and alert channel id have been set only then will an alert be sent.
-                    if alert_time:
-                        if alert_channel_id:
-                            try:
-                                if self.bot.guild_prefs[guild_record['id']] is None:
-                                    await self.bot.get_cog('Configuration').create_default_guild_prefs(guild_record['id'])
-                                    continue
-                                elif not self.bot.guild_prefs[guild_record['id']].get('birthdays'):
-                                    continue
-                            except KeyError:
-                                await self.bot.get_cog('Configuration').create_default_guild_prefs(guild_record['id'])
-                                continue
-
-                            async for record in conn.cursor(query, guild_record.get('id')):
-                                self.bot.loop.create_task(
-                                    self.send_wish(guild_record['id'], alert_channel_id, record.get('memberid'), new_time))
-
-    @bday_poll.before_loop
-    async def kellog(self):
+    async def alert_loop(self):
+        """
+        The one background task of the birthday system, sleeps until the next guild in the timeline is due (or the
+        timeline changes) and only ever looks at the guilds that are due
+        """
         await self.bot.wait_until_ready()
+        while not self._loaded:
+            try:
+                await self.load_timeline()
+            except Exception as error:
+                print(f"Couldn't load the birthday timeline: {error!r}")
+                await asyncio.sleep(60)
+
+        while True:
+            now = datetime.datetime.utcnow()
+            if self._cleaned != now.date():
+                try:
+                    await self.bot.db.forget_birthdays_sent(now.date() - datetime.timedelta(days=SENT_MARKER_DAYS))
+                    self._cleaned = now.date()
+                except Exception as error:
+                    print(f"Couldn't forget old birthday alerts: {error!r}")
+
+            due = self._timeline.pop_due(now)
+            if due:
+                try:
+                    await self.fire_alerts(due)
+                except Exception as error:
+                    print(f"Couldn't fire birthday alerts: {error!r}")
+                    # Tried again in a minute
+                    for guildid, _, (channelid, alert_time, timezone, day) in due:
+                        if guildid not in self._timeline:
+                            self._timeline.push(guildid, now + datetime.timedelta(minutes=1),
+                                                (channelid, alert_time, timezone, day))
+
+            self._timeline_changed.clear()
+            now = datetime.datetime.utcnow()
+            midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time.min)
+            earliest = self._timeline.peek()
+            wake = min(earliest, midnight) if earliest is not None else midnight
+            try:
+                await asyncio.wait_for(self._timeline_changed.wait(), max((wake - now).total_seconds(), 0))
+            except asyncio.TimeoutError:
+                pass
 
     @commands.command()
     @commands.has_guild_permissions(manage_guild=True)
@@ -145,22 +356,46 @@ class BirthdaySystem(commands.Cog, name="Birthday system"):
         """
         Sets the time of auto birthday alerts.
 
-        The time provided must be in UTC and of the format "HH MM"
+        The time provided must be of the format "HH MM", in the server's timezone (UTC unless set with the bdtimezone command)
         Note that you need to have the "Manage server" permisission to use this command
         """
         tim = datetime.datetime.strptime(time, "%H %M").time()
-        await self.bot.pool.execute("UPDATE guilds SET bdayalerttime = $1 WHERE id = $2", tim, ctx.guild.id)
+        timezone = await self.bot.pool.fetchval("UPDATE guilds SET bdayalerttime = $1 WHERE id = $2 RETURNING timezone",
+                                                tim, ctx.guild.id)
+
+        e = discord.Embed(title="Success!",
+                          description=f"Birthday alerts will be sent out on this server at {tim.strftime('%H:%M')} ({timezone or 'UTC'})",
+                          colour=discord.Colour.green())
+        await ctx.send(embed=e)
+        await self.reschedule_guild(ctx.guild.id)
+
+    @commands.command()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def bdtimezone(self, ctx: commands.Context, timezone: str):
+        """
+        Sets the timezone birthday alerts follow.
+
+        `timezone` here is an IANA timezone name like `Europe/Berlin` or `America/New_York`, or `UTC`. Daylight saving time is taken care of.
+        The alert time set with bdalerttime is then in this timezone, and birthdays go by the date there.
+        Note that you need to have the "Manage server" permisission to use this command
+        """
+        try:
+            zone(timezone)
+        except ValueError as error:
+            return await ctx.send(f"{error}, use a name like `Europe/Berlin` (see https://en.wikipedia.org/wiki/List_of_tz_database_time_zones)")
+        await self.bot.pool.execute("UPDATE guilds SET timezone = $1 WHERE id = $2", timezone, ctx.guild.id)
+        self._timezones[ctx.guild.id] = timezone
 
         e = discord.Embed(title="Success!",
-                          description=f"Birthday alerts will be sent out on this server at {tim.strftime('%H:%M')} (UTC)",
+                          description=f"Birthday alerts will follow the timezone {timezone}",
                           colour=discord.Colour.green())
         await ctx.send(embed=e)
-        await self.bday_poll()
+        await self.reschedule_guild(ctx.guild.id)
 
     @commands.command(hidden=True)
     @commands.check(lambda ctx: ctx.author.id == 501451372147769355)
     async def checkbd(self, ctx: commands.Context):
-        await self.bday_poll()
+        await self.load_timeline()
 
     @commands.command()
     @commands.has_guild_permissions(manage_guild=True)
@@ -177,6 +412,7 @@ class BirthdaySystem(commands.Cog, name="Birthday system"):
                               description=f'The channel {alert_channel.mention} will be used for auto birthday alerts',
                               colour=discord.Colour.green())
             await ctx.send(embed=e)
+        await self.reschedule_guild(ctx.guild.id)
 
 
 def setup(bot: Zeta):
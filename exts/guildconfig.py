@@ -73,7 +73,7 @@ class GuildConfig(commands.Cog, name="Configuration"):
         """
         # hehe
         await ctx.send(embed=discord.Embed(title='Plugins for this server:',
-                                           description='\n'.join([f"{k} : {'enabled' if v else 'disabled'}" for k, v in self.bot.guild_prefs[ctx.guild.id].items()]),
+                                           description='\n'.join([f"{p} : {'enabled' if self.bot.guild_prefs[ctx.guild.id].get(p) else 'disabled'}" for p in self.bot.plugins]),
                                            colour=self.bot.Color.light_pink()))
 
     @_plugin.command()
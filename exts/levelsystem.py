@@ -1,9 +1,12 @@
+import io
+import json
+import util
 import asyncio
 import discord
 import datetime
+import collections
 from main import Zeta
 from typing import Union
-from math import floor, sqrt
 from discord.ext import commands, tasks
 
 
@@ -13,6 +16,77 @@ def is_me(ctx):
 
 QUERY_INTERVAL_MINUTES = 10
 
+# Guilds are split into this many slots by id, spread evenly over the interval, each slot flushed in one transaction
+FLUSH_SLOTS = 10
+
+# Exp/boost changes that haven't been flushed yet are logged here, see util.XPJournal
+JOURNAL_PATH = 'levels.journal'
+
+# Cached members that haven't sent a message in this many minutes get evicted after a flush
+CACHE_IDLE_MINUTES = 60
+
+# Upper bound on the number of members kept in the cache, least recently active ones are evicted beyond it
+CACHE_MAX_MEMBERS = 250000
+
+# On startup the cache is preloaded with up to this many members (highest exp first) of every guild
+PRELOAD_MEMBERS_PER_GUILD = 500
+
+# Members shown per leaderboard page, and fetched per query when building a guild's leaderboard
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_LOAD_BATCH = 5000
+
+# Upper bound on the number of members ranked across all in-memory leaderboards, the least recently viewed
+# leaderboards are dropped beyond it
+LEADERBOARD_MAX_MEMBERS = 1000000
+
+# Level ups in a channel within this many seconds of each other get announced in a single message
+ANNOUNCEMENT_WINDOW_SECONDS = 10
+
+
+class LevelUpAnnouncer:
+    """
+    Collects level up announcements per channel, the first level up in a channel opens a short window and everything
+    that levels up in that channel before it closes gets sent as one message instead of an embed each.
+    """
+    def __init__(self, bot: Zeta, window: float):
+        self.bot = bot
+        self.window = window
+
+        # channel_id -> (channel, {member: new level})
+        self._pending = {}
+
+    def add(self, channel: discord.TextChannel, member: discord.Member, level: int) -> None:
+        """
+        Queues up a level up announcement in a channel
+        """
+        if channel.id not in self._pending:
+            self._pending[channel.id] = (channel, {})
+            self.bot.loop.create_task(self.send_later(channel.id))
+        # A member levelling up twice in one window only needs their latest level announced
+        self._pending[channel.id][1][member] = level
+
+    async def send_later(self, channel_id: int) -> None:
+        await asyncio.sleep(self.window)
+        channel, levels = self._pending.pop(channel_id)
+
+        if len(levels) == 1:
+            member, level = next(iter(levels.items()))
+            embed = discord.Embed(title=f"{member}",
+                                  description=f"GZ on level {level}, {member.mention}",
+                                  color=discord.Colour.green())
+        else:
+            lines = [f"{member.mention} reached level {level}" for member, level in levels.items()]
+            description = ""
+            for count, line in enumerate(lines):
+                if len(description) + len(line) > 1900:
+                    description += f"...and {len(lines) - count} more"
+                    break
+                description += line + "\n"
+            embed = discord.Embed(title="GZ on the level ups!",
+                                  description=description,
+                                  color=discord.Colour.green())
+        await channel.send(embed=embed)
+
 
 class LevelSystem(commands.Cog, name="Levelling"):
     """
@@ -23,9 +97,32 @@ class LevelSystem(commands.Cog, name="Levelling"):
         super().__init__()
         self.bot = bot
 
-        # Look up implementation inside the add_to_cache function docstring
-        self._cache = {}
-        asyncio.get_event_loop().create_task(self.load_cache())
+        # Look up implementation inside the util.LevelCache docstring
+        self._cache = util.LevelCache(CACHE_MAX_MEMBERS, CACHE_IDLE_MINUTES * 60)
+
+        # guild_id -> util.Leaderboard, built the first time a guild's leaderboard/rank is needed, least recently used
+        # first. Dropped once the guild has no cached members left, see update_level_db
+        self._leaderboards = collections.OrderedDict()
+
+        # guild_id -> task building that guild's leaderboard, see get_leaderboard
+        self._lb_loading = {}
+
+        # guild_id -> {0 based page number: rendered leaderboard page embed}, see leaderboard_changed
+        self._lb_pages = {}
+
+        # (guild_id, member_id) -> task loading that member into the cache, see add_to_cache
+        self._loading = {}
+
+        # Flushes move journal records around, so only one may run at a time
+        self._flush_lock = asyncio.Lock()
+
+        # Nothing may be read from the database into the cache before the journal has been replayed into it
+        self.journal = util.XPJournal(JOURNAL_PATH)
+        self._replayed = asyncio.Event()
+        self.bot.loop.create_task(self.replay_journal())
+        self.bot.loop.create_task(self.preload_cache())
+
+        self.announcer = LevelUpAnnouncer(bot, ANNOUNCEMENT_WINDOW_SECONDS)
 
         # Start the loop that dumps cache to database every 10 minutes
         self.update_level_db.start()
@@ -45,11 +142,68 @@ class LevelSystem(commands.Cog, name="Levelling"):
                 await ctx.send("The `levelling` plugin has been disabled on this server therefore related commands will not work\n"
                                "Hint: Server admins can enable it using the `plugin enable` command, use the help command to learn more.")
 
-    async def load_cache(self):
-        for guild in self.bot.guilds:
-            self._cache[guild.id] = {}
+    def cog_unload(self):
+        self.update_level_db.cancel()
+        self.journal.close()
+
+    async def replay_journal(self) -> None:
+        """
+        Writes the changes logged in the journal before the last shutdown/crash into the database, then truncates it
+
+        :return: None
+        """
+        async with self._flush_lock:
+            checkpoint = self.journal.checkpoint()
+            changes = self.journal.pending()
+            while True:
+                try:
+                    await self.bot.db.apply_member_changes([(guild_id, member_id, exp, boost)
+                                                            for (guild_id, member_id), (exp, boost) in changes.items()])
+                    break
+                except Exception as error:
+                    print(f"Replaying the level system journal failed ({error!r}), retrying in 30 seconds")
+                    await asyncio.sleep(30)
+            self.journal.truncate(checkpoint)
+            self._replayed.set()
+        if changes:
+            print(f"Level system journal replayed for {len(changes)} members at {datetime.datetime.utcnow()}")
+
+    async def preload_cache(self) -> None:
+        """
+        Streams the most active members of every guild the bot is in into the cache with a single query, so the first
+        messages after a restart don't each need a query of their own
+
+        :return: None
+        """
+        await self.bot.wait_until_ready()
+        await self._replayed.wait()
+        # One top-N index scan of the leaderboard index per guild, rather than ranking every member of every guild
+        query = "SELECT g.id AS guildid, m.memberid, m.level, m.exp, m.boost " \
+                "FROM unnest($1::bigint[]) AS g(id) CROSS JOIN LATERAL (" \
+                "SELECT memberid, level, exp, boost FROM server_members " \
+                "WHERE guildid = g.id ORDER BY exp DESC LIMIT $2" \
+                ") AS m"
+        count = 0
+        async with self.bot.scheduler.connection_slot(), self.bot.pool.acquire() as conn:
+            async with conn.transaction():
+                async for entry in conn.cursor(query, [guild.id for guild in self.bot.guilds], PRELOAD_MEMBERS_PER_GUILD):
+                    if len(self._cache) >= self._cache.max_members:
+                        break
+                    # Members that sent a message while this was running are already cached with newer values
+                    if (entry.get('guildid'), entry.get('memberid')) in self._cache:
+                        continue
+                    self._cache.put(entry.get('guildid'), entry.get('memberid'),
+                                    entry.get('level'), entry.get('exp'), entry.get('boost'))
+                    count += 1
+        print(f"Level system cache preloaded with {count} members at {datetime.datetime.utcnow()}")
+
+    def curve_for(self, guild_id: int) -> util.LevelCurve:
+        """
+        Returns the level curve a guild has set in its preferences, the default one if it hasn't set any
+        """
+        return util.LevelCurve.from_prefs(self.bot.guild_prefs.get(guild_id))
 
-    async def give_exp(self, guild_id: int, member_id: int, amount=None) -> None:
+    async def give_exp(self, guild_id: int, member_id: int, amount=None) -> util.MemberRecord:
         """
         Function to give exp to a particular member
 
@@ -57,125 +211,266 @@ class LevelSystem(commands.Cog, name="Levelling"):
         :param guild_id: The id of the guild in question
         :param member_id: The id of the member in the guild
         :param amount: The amount of exp to give, default to None in which case the default level up exp is awarded
-        :return: None
+        :return: the member's updated cache record
         """
-        if member_id not in self._cache[guild_id]:
-            await self.add_to_cache(guild_id, member_id)
+        record = self._cache.get(guild_id, member_id)
+        if record is None:
+            record = await self.add_to_cache(guild_id, member_id)
 
         if not amount:
-            amount = 5 * self._cache[guild_id][member_id]['boost']
-        self._cache[guild_id][member_id]['exp'] += amount
-
-    async def add_to_cache(self, guild_id: int, member_id: int) -> Union[dict, None]:
+            amount = 5 * record.boost
+        record = self._cache.add_exp(guild_id, member_id, amount)
+        self.journal.exp(guild_id, member_id, amount)
+        if guild_id in self._leaderboards:
+            self.leaderboard_changed(guild_id, self._leaderboards[guild_id].update(member_id, record.exp))
+        return record
+
+    async def add_to_cache(self, guild_id: int, member_id: int) -> util.MemberRecord:
         """
-        Function that adds a member to the cache
+        Function that adds a member to the cache, creating their database entry if they don't have one yet
 
-        Cache: \n
-            type = dict \n
-            format: \n
-            {
-                guild_id : {
-                    member_id : {
-                        'id' : "the id of the member",\n
-                        'level' : "the level of the member",\n
-                        'exp' : "the exp of the member", \n
-                        'boost' : "the boost multiplier", \n
-
-                    }
-                }
-            }
+        The cache is a util.LevelCache, look up its docstring for how members are stored.
+        Concurrent calls for the same member share a single load instead of each running their own queries.
 
         :param guild_id: the id of the guild
         :param member_id: the id of the member belonging to that guild
-        :return: data(dict) - The member that was just put inside db, same format as cache.
+        :return: util.MemberRecord - The cache record of the member
         """
-        if guild_id in self._cache and member_id in self._cache[guild_id]:
-            pass
-
         if type(guild_id) is not int:
             raise TypeError("guild id must be int")
 
-        data = await self.bot.db.fetch_member(guild_id, member_id)
+        key = (guild_id, member_id)
+        task = self._loading.get(key)
+        if task is None:
+            task = self._loading[key] = self.bot.loop.create_task(self._load_member(guild_id, member_id))
+            task.add_done_callback(lambda _: self._loading.pop(key, None))
 
-        if data:
-            self._cache[guild_id][member_id] = {
-                'id': data.get('id'),
-                'level': data.get('level'),
-                'exp': data.get('exp'),
-                'boost': data.get('boost'),
-            }
-        else:
-            await self.add_to_db(guild_id, member_id)
-            await self.add_to_cache(guild_id, member_id)  # important
-        return data
+        # Shielded so that one waiter getting cancelled doesn't cancel the load for everyone else
+        return await asyncio.shield(task)
 
-    async def add_to_db(self, guild_id: int, member_id: int) -> None:
+    async def _load_member(self, guild_id: int, member_id: int) -> util.MemberRecord:
+        await self._replayed.wait()
+        data = await self.bot.db.fetch_or_make_member(guild_id, member_id)
+
+        # The member might have been cached by something else while the query was running (the preload for instance),
+        # that record may already have unflushed exp on it so it wins
+        record = self._cache.get(guild_id, member_id)
+        if record is not None:
+            return record
+        return self._cache.put(guild_id, member_id, data.get('level'), data.get('exp'), data.get('boost'))
+
+    async def flush_guilds(self, guild_ids=None) -> int:
         """
-        A function that adds a new entry to the database with default values
+        Function that writes the dirty cache entries of some guilds into the database in a single transaction, then
+        drops their journal records up to that point.
 
-        (and not dump existing cache into database)
+        :param guild_ids: the ids of the guilds to flush, defaults to every guild
+        :return: the number of members written
+        """
+        async with self._flush_lock:
+            # Both have to be taken together, the journal can only lose what the dirty records being written cover
+            checkpoint = self.journal.checkpoint()
+            records = self._cache.take_dirty(guild_ids)
+            try:
+                async with self.bot.scheduler.connection_slot():
+                    await self.bot.db.update_members(records)
+            except Exception:
+                # Didn't make it into the database, so they have to be written on the next go
+                self._cache.mark_dirty(records)
+                raise
+            if guild_ids is None:
+                self.journal.truncate(checkpoint)
+            else:
+                self.journal.compact(guild_ids, checkpoint)
+            return len(records)
 
-        :param guild_id: The relevant guild
-        :param member_id: The id of the member
+    def journal_reset(self, guild_id: int, member_id: int) -> None:
+        """
+        Logs a member's reset in the journal, only if it may hold changes of theirs the reset has to void, so members
+        leaving don't fill it up. Has to be called before the member is removed from the cache.
+
+        :param guild_id: the id of the guild in question
+        :param member_id: the id of the member being reset
         :return: None
         """
-        await self.bot.db.make_member_entry(guild_id, member_id)
+        # Logged changes are either still dirty, being flushed right now, or from before the journal got replayed, in
+        # which case nothing is cached for the guild yet
+        if self._cache.is_dirty(guild_id, member_id) or self._flush_lock.locked() or not self._cache.has_guild(guild_id):
+            self.journal.reset(guild_id, member_id)
 
-    async def dump_single_guild(self, guildid: int):
+    async def import_members(self, guild_id: int, members: list) -> None:
         """
-        Function that dumps all entries from a single guild in the cache to the database.
+        Function that bulk imports members' exp into the database, then merges them into the cache and leaderboard
+        of the guild in place
 
-        :param guildid: the id of the guild whose cache entry needs to be dumped
+        :param guild_id: the id of the guild in question
+        :param members: list of (memberid, exp, boost) tuples, as returned by util.read_member_csv
         :return: None
         """
-        data = self._cache[guildid]
-        for memberid in list(data):
-            current = data[memberid]
-            query = f"UPDATE server_members " \
-                    f"SET level = $1, " \
-                    f"exp = $2, " \
-                    f"boost = $3" \
-                    f"WHERE memberid = $4 AND guildid = $5"
+        curve = self.curve_for(guild_id)
+        records = [(member_id, curve.level_for(exp), exp, boost) for member_id, exp, boost in members]
+        await self._replayed.wait()
+
+        # Held so a flush can't write older cached values over the imported ones
+        async with self._flush_lock:
+            await self.bot.db.import_members(guild_id, records)
+            leaderboard = self._leaderboards.get(guild_id)
+            for member_id, level, exp, boost in records:
+                if (guild_id, member_id) in self._cache:
+                    # The import overwrites whatever the member had, unflushed exp and its journal records included
+                    self._cache.remove(guild_id, member_id)
+                    self._cache.put(guild_id, member_id, level, exp, boost)
+                    self.journal.reset(guild_id, member_id)
+                if leaderboard is not None:
+                    leaderboard.update(member_id, exp)
+            self._lb_pages.pop(guild_id, None)
+
+    async def get_leaderboard(self, guild_id: int) -> util.Leaderboard:
+        """
+        Function that returns the in-memory leaderboard of a guild, the first call for a guild builds it and from then
+        on give_exp keeps it up to date
 
-            await self.bot.pool.execute(query,
-                                        current['level'],
-                                        current['exp'],
-                                        current['boost'],
-                                        memberid, guildid)
+        Concurrent calls for a guild share a single build, same as add_to_cache does for members.
 
-    async def fetch_top_n(self, guild: discord.Guild, limit: int):
+        :param guild_id: the id of the guild in question
+        :return: util.Leaderboard
+        """
+        leaderboard = self._leaderboards.get(guild_id)
+        if leaderboard is not None:
+            self._leaderboards.move_to_end(guild_id)
+            return leaderboard
+
+        task = self._lb_loading.get(guild_id)
+        if task is None:
+            task = self._lb_loading[guild_id] = self.bot.loop.create_task(self._build_leaderboard(guild_id))
+            task.add_done_callback(lambda _: self._lb_loading.pop(guild_id, None))
+        return await asyncio.shield(task)
+
+    async def _build_leaderboard(self, guild_id: int) -> util.Leaderboard:
+        await self._replayed.wait()
+
+        # Fetched in keyset paginated batches, so they come out of the leaderboard index already sorted
+        entries = []
+        after = None
+        while True:
+            batch = await self.bot.db.fetch_leaderboard_page(guild_id, LEADERBOARD_LOAD_BATCH, after)
+            entries += [(entry.get('memberid'), entry.get('exp')) for entry in batch]
+            if len(batch) < LEADERBOARD_LOAD_BATCH:
+                break
+            after = (batch[-1].get('exp'), batch[-1].get('memberid'))
+
+        # The cache can be ahead of the database, and it might have received messages while the query was running
+        leaderboard = self._leaderboards[guild_id] = util.Leaderboard(entries)
+        for record in self._cache.members(guild_id):
+            leaderboard.update(record.id, record.exp)
+        self._lb_pages.pop(guild_id, None)
+        self.trim_leaderboards()
+        return leaderboard
+
+    def trim_leaderboards(self) -> None:
+        """
+        Drops the least recently viewed leaderboards until they rank at most LEADERBOARD_MAX_MEMBERS members together,
+        the most recently viewed one is always kept even if it's larger than that on its own
         """
-        Function to fetch top n members of a guild based off exp, works by initially dumping the guild into the database
-        then using an sql query to fetch the top n members
+        ranked = sum(len(leaderboard) for leaderboard in self._leaderboards.values())
+        while ranked > LEADERBOARD_MAX_MEMBERS and len(self._leaderboards) > 1:
+            guild_id = next(iter(self._leaderboards))
+            ranked -= len(self._leaderboards[guild_id])
+            self.drop_leaderboard(guild_id)
+
+    def drop_leaderboard(self, guild_id: int) -> None:
+        """Forgets a guild's leaderboard and its rendered pages, the next lookup builds it again"""
+        self._leaderboards.pop(guild_id, None)
+        self._lb_pages.pop(guild_id, None)
+
+    def leaderboard_changed(self, guild_id: int, span) -> None:
+        """
+        Drops the rendered leaderboard pages of a guild that a change in its leaderboard touched
+
+        :param guild_id: the id of the guild in question
+        :param span: what util.Leaderboard.update/remove returned for the change
+        :return: None
+        """
+        pages = self._lb_pages.get(guild_id)
+        if not pages or span is None:
+            return
+        first, last = span
+        for page in list(pages):
+            if (page + 1) * LEADERBOARD_PAGE_SIZE > first and (last is None or page * LEADERBOARD_PAGE_SIZE <= last):
+                del pages[page]
+
+    def remove_from_leaderboard(self, guild_id: int, member_id: int) -> None:
+        if guild_id in self._leaderboards:
+            self.leaderboard_changed(guild_id, self._leaderboards[guild_id].remove(member_id))
+
+    async def fetch_top_n(self, guild: discord.Guild, limit: int, offset: int = 0):
+        """
+        Function to fetch top n members of a guild based off exp, served from the guild's in-memory leaderboard
 
         :param guild: the guild in question
         :param limit: the number of members to fetch
-        :return: None
+        :param offset: the number of top members to skip
+        :return: list of dicts with the keys rank, id, exp and level
         """
+        leaderboard = await self.get_leaderboard(guild.id)
+        curve = self.curve_for(guild.id)
+        return [{'rank': rank, 'id': member_id, 'exp': exp, 'level': curve.level_for(exp)}
+                for rank, member_id, exp in leaderboard.top(limit, offset)]
 
-        if guild.id in self._cache:
-            await self.dump_single_guild(guild.id)
+    async def leaderboard_page(self, guild: discord.Guild, page: int) -> discord.Embed:
+        """
+        Function that renders a page of a guild's leaderboard, rendered pages are kept until a change touches them
 
-        async with self.bot.pool.acquire() as conn:
-            async with conn.transaction():
-                top10 = []
-                rank = 1
-                async for entry in conn.cursor("SELECT memberid, exp, level FROM server_members WHERE guildid = $1 ORDER BY exp DESC LIMIT $2", guild.id, limit):
-                    top10 += [{'rank': rank, 'id': entry.get('memberid'), 'exp': entry.get('exp'), 'level': entry.get('level')}]
-                    rank += 1
-                return top10
+        :param guild: the guild in question
+        :param page: 0 based page number
+        :return: discord.Embed
+        """
+        pages = self._lb_pages.setdefault(guild.id, {})
+        if page in pages:
+            return pages[page]
+
+        data = await self.fetch_top_n(guild, LEADERBOARD_PAGE_SIZE, page * LEADERBOARD_PAGE_SIZE)
+        embed = discord.Embed(title=f"Server leaderboard (page {page + 1})",
+                              colour=discord.Colour.green())
+        for entry in data:
+            m = guild.get_member(entry.get('id'))
+            if m is None:
+                display_name = f"Deleted user (id:{entry.get('id')})"
+                embed.set_footer(text="Hint: mods can use the reset command to get rid of the \"Deleted user\" in the leaderboard if they have left the server")
+            else:
+                display_name = m.display_name
+            embed.add_field(name=f"{entry.get('rank')}.{display_name}",
+                            value=f"Level: {entry.get('level')} Exp: {entry.get('exp')}",
+                            inline=False)
+
+        # The guild's pages may have been dropped while this was being built
+        self._lb_pages.setdefault(guild.id, {})[page] = embed
+        return embed
 
     @tasks.loop(minutes=QUERY_INTERVAL_MINUTES)
     async def update_level_db(self):
         """
-        Loop that dumps the cache into db every 10 minutes
+        Loop that dumps the dirty part of the cache into db every 10 minutes, then evicts idle members from the cache
+        along with the leaderboards of guilds left without any
+
+        Guilds are flushed in FLUSH_SLOTS batches spread over the 10 minutes rather than all at once.
 
         :return: None
         """
-        for guildId in self._cache:
-            await self.dump_single_guild(guildId)
-            self._cache[guildId] = {}
-        print(f"Level system database updated at {datetime.datetime.utcnow()}")
+        async with self.bot.scheduler.cycle('level flush'):
+            # Guilds with nothing cached can still have journal records (resets, for one) that need compacting away
+            written = sum(await self.bot.scheduler.staggered(
+                lambda: set(self._cache.guild_ids()) | self.journal.guild_ids(), QUERY_INTERVAL_MINUTES * 60,
+                FLUSH_SLOTS, self.flush_guilds))
+            evicted = self._cache.evict()
+            # Guilds nobody has been active in for a while don't need their leaderboard kept around either
+            active = set(self._cache.guild_ids())
+            for guild_id in [g for g in self._leaderboards if g not in active]:
+                self.drop_leaderboard(guild_id)
+            # give_exp keeps ranking new members into the ones that are left
+            self.trim_leaderboards()
+        print(f"Level system database updated at {datetime.datetime.utcnow()}, "
+              f"{written} members written, {evicted} evicted from cache")
 
     @update_level_db.before_loop
     async def preloop(self) -> None:
@@ -205,30 +500,43 @@ class LevelSystem(commands.Cog, name="Levelling"):
         # Bots shouldn't be levelling up
         if not message.author.bot:
             # This bit awards exp points
-            if message.guild.id not in self._cache:
-                self._cache[message.guild.id] = {}
-                await self.add_to_cache(message.guild.id, message.author.id)
-            if message.author.id not in self._cache[message.guild.id]:
-                await self.add_to_cache(message.guild.id, message.author.id)
-            await self.give_exp(message.guild.id, message.author.id)
+            record = await self.give_exp(message.guild.id, message.author.id)
 
             # This bit checks if level up happened
-            OldLevel = self._cache[message.guild.id][message.author.id]['level']
-            NewLevel = floor((25 + sqrt(625 + 100 * self._cache[message.guild.id][message.author.id]['exp'])) / 50)
+            OldLevel = record.level
+            NewLevel = self.curve_for(message.guild.id).level_for(record.exp)
             if NewLevel > OldLevel:
-                self._cache[message.guild.id][message.author.id]['level'] = NewLevel
-                embed = discord.Embed(title=f"{message.author}",
-                                      description=f"GZ on level {NewLevel}, {message.author.mention}",
-                                      color=discord.Colour.green())
-                await message.channel.send(embed=embed)
+                self._cache.update(message.guild.id, message.author.id, level=NewLevel)
+                channel = self.announcement_channel(message)
+                if channel is not None:
+                    self.announcer.add(channel, message.author, NewLevel)
+
+    def announcement_channel(self, message: discord.Message) -> Union[discord.TextChannel, None]:
+        """
+        Returns the channel a level up caused by a message should be announced in as per the guild's `levelups`
+        preference, None if the guild turned announcements off
+        """
+        route = self.bot.guild_prefs[message.guild.id].get('levelups')
+        if route == 'off':
+            return None
+        if route is not None:
+            # Falls back to the message's channel if the announcement channel got deleted
+            return message.guild.get_channel(route) or message.channel
+        return message.channel
 
     @commands.Cog.listener()
     async def on_guild_remove(self, guild: discord.Guild):
-        self._cache[guild.id] = {}
+        self._cache.drop_guild(guild.id)
+        self.drop_leaderboard(guild.id)
+        # The unflushed exp just thrown away would otherwise come back with the next replay
+        async with self._flush_lock:
+            self.journal.compact([guild.id], self.journal.checkpoint())
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
-        self._cache[member.guild.id].pop(member.id)
+        self.journal_reset(member.guild.id, member.id)
+        self._cache.remove(member.guild.id, member.id)
+        self.remove_from_leaderboard(member.guild.id, member.id)
         await self.bot.db.hakai_member(member.guild.id, member.id)
 
     @commands.command()
@@ -240,40 +548,32 @@ class LevelSystem(commands.Cog, name="Levelling"):
         """
         if not target:
             target = ctx.author
-        if ctx.guild.id in self._cache and target.id in self._cache[ctx.guild.id]:
-            data = self._cache[ctx.guild.id][target.id]
-        else:
+        data = self._cache.get(ctx.guild.id, target.id)
+        if data is None:
             data = await self.add_to_cache(ctx.guild.id, target.id)
-        if not data:
+        if not data.exp:
             await ctx.send(f"{target} hasn't been ranked yet! tell them to send some messages to start.")
             return
+        rank = (await self.get_leaderboard(ctx.guild.id)).rank(target.id)
         embed = discord.Embed(title=f"{target}",
-                              description=f"You are currently on level : {data['level']}\n"
-                                          f"With exp : {data['exp']}",
+                              description=f"You are currently on level : {data.level}\n"
+                                          f"With exp : {data.exp}\n"
+                                          f"Your rank is #{rank}",
                               colour=discord.Colour.blue())
         await ctx.send(embed=embed)
 
     @commands.command()
-    async def lb(self, ctx):
-        """
-        Shows the top 10 server members based off their exp.
+    async def lb(self, ctx, page: int = 1):
         """
-        data = await self.fetch_top_n(ctx.guild, limit=10)
+        Shows the server members ranked by their exp, 10 per page.
 
-        embed = discord.Embed(title="Server leaderboard",
-                              colour=discord.Colour.green())
-        for entry in data:
-            m = ctx.guild.get_member(entry.get('id'))
-            if m is None:
-                display_name = f"Deleted user (id:{entry.get('id')})"
-                embed.set_footer(text="Hint: mods can use the reset command to get rid of the \"Deleted user\" in the leaderboard if they have left the server")
-            else:
-                display_name = m.display_name
-            embed.add_field(name=f"{entry.get('rank')}.{display_name}",
-                            value=f"Level: {entry.get('level')} Exp: {entry.get('exp')}",
-                            inline=False)
-
-        await ctx.send(embed=embed)
+        `page` (optional) is the page to start on, defaults to the first one. Use the reactions under the leaderboard to flip through pages.
+        """
+        leaderboard = await self.get_leaderboard(ctx.guild.id)
+        pages = max(1, -(-len(leaderboard) // LEADERBOARD_PAGE_SIZE))
+        paginator = util.EmbedPaginator(self.bot, ctx.channel, lambda n: self.leaderboard_page(ctx.guild, n), pages,
+                                        user=ctx.author)
+        await paginator.start(min(max(page, 1), pages) - 1)
 
     @commands.command()
     @commands.has_guild_permissions(manage_messages=True)
@@ -286,11 +586,115 @@ class LevelSystem(commands.Cog, name="Levelling"):
         `target` here is the member whose multiplier you wish to set, can be mention, id or username
         `multiplier` here is the exp multiplier you want to set, a value of 2 will indicate twice as fast levelling
         """
-        if target.id not in self._cache[ctx.guild.id]:
+        if (ctx.guild.id, target.id) not in self._cache:
             await self.add_to_cache(ctx.guild.id, target.id)
-        self._cache[ctx.guild.id][target.id]['boost'] = int(multiplier)
+        self._cache.update(ctx.guild.id, target.id, boost=int(multiplier))
+        self.journal.boost(ctx.guild.id, target.id, int(multiplier))
         await ctx.send(f"{target}'s multiplier has been set to {multiplier}")
 
+    @commands.command()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def levelups(self, ctx: commands.Context, where: Union[discord.TextChannel, str]):
+        """
+        Sets where level up announcements are sent
+
+        `where` here can be a channel (mention, id or name) to send all announcements to that channel, `here` to announce level ups in the channel the member was chatting in (the default), or `off` to not announce level ups at all
+        Level ups happening close together in a channel get announced in a single message.
+        Note that you need to have the server permission "Manage server" to use this command
+        """
+        if isinstance(where, discord.TextChannel):
+            route, description = where.id, f"Level ups will be announced in {where.mention}"
+        elif where.lower() == 'here':
+            route, description = None, "Level ups will be announced in the channel the member levelled up in"
+        elif where.lower() == 'off':
+            route, description = 'off', "Level ups will no longer be announced"
+        else:
+            await ctx.send("Invalid option, use a channel, `here` or `off`")
+            return
+
+        self.bot.guild_prefs[ctx.guild.id]['levelups'] = route
+        await self.bot.pool.execute("UPDATE guilds SET preferences = $1 WHERE id = $2",
+                                    json.dumps(self.bot.guild_prefs[ctx.guild.id]), ctx.guild.id)
+        await ctx.send(embed=discord.Embed(title="Success", description=description, colour=discord.Colour.green()))
+
+    @commands.command()
+    @commands.has_guild_permissions(manage_guild=True)
+    async def levelcurve(self, ctx: commands.Context, name: str = None, factor: int = None):
+        """
+        Shows or changes how much exp each level needs on this server
+
+        Used without arguments it shows the curve currently in use.
+        `name` here is the curve you wish to use, can be `quadratic` (the default), `linear` or `exponential`
+        `factor` (optional) scales the curve, a higher factor means more exp is needed for every level, each curve has its own default
+        Changing the curve recomputes the level of every member of the server right away.
+        Note that you need to have the server permission "Manage server" to use this command
+        """
+        if name is None:
+            await ctx.send(f"This server uses the {self.curve_for(ctx.guild.id)} level curve")
+            return
+        try:
+            curve = util.LevelCurve(name.lower(), factor)
+        except ValueError as error:
+            await ctx.send(str(error))
+            return
+
+        self.bot.guild_prefs[ctx.guild.id]['levelcurve'] = curve.to_prefs()
+        await self.bot.pool.execute("UPDATE guilds SET preferences = $1 WHERE id = $2",
+                                    json.dumps(self.bot.guild_prefs[ctx.guild.id]), ctx.guild.id)
+
+        # Every row is recomputed by one UPDATE, cached members get recomputed here as well since they can be ahead
+        # of the database
+        await self.bot.db.relevel_guild(ctx.guild.id, curve.thresholds, curve.level_for)
+        self._cache.set_levels(ctx.guild.id, curve.levels_for)
+        self._lb_pages.pop(ctx.guild.id, None)
+
+        e = discord.Embed(title="Success",
+                          description=f"This server now uses the {curve} level curve",
+                          colour=discord.Colour.green())
+        await ctx.send(embed=e)
+
+    @commands.command()
+    @commands.has_guild_permissions(administrator=True)
+    async def xpimport(self, ctx: commands.Context):
+        """
+        Imports the exp of many members at once from a CSV file attached to the command message
+
+        Meant for moving over from other levelling bots, every line of the file has to be `memberid,exp`, optionally followed by `,level,boost` (which is what `xpexport` gives out). Levels are worked out from exp with this server's level curve.
+        Members in the file that already have exp on this server get it overwritten.
+        Note that you need to have the server permission "Administrator" to use this command
+        """
+        if not ctx.message.attachments:
+            await ctx.send("Attach the CSV file you wish to import to the command message")
+            return
+        try:
+            members = util.read_member_csv((await ctx.message.attachments[0].read()).decode('utf-8'))
+        except ValueError as error:
+            await ctx.send(f"Invalid file: {error}")
+            return
+
+        async with ctx.channel.typing():
+            await self.import_members(ctx.guild.id, members)
+        e = discord.Embed(title="Success",
+                          description=f"Imported the exp of {len(members)} members",
+                          colour=discord.Colour.green())
+        await ctx.send(embed=e)
+
+    @commands.command()
+    @commands.has_guild_permissions(administrator=True)
+    async def xpexport(self, ctx: commands.Context):
+        """
+        Sends the exp, level and multiplier of every member of this server as a CSV file
+
+        The file can be imported back using the `xpimport` command.
+        Note that you need to have the server permission "Administrator" to use this command
+        """
+        async with ctx.channel.typing():
+            await self.flush_guilds([ctx.guild.id])
+            buffer = io.BytesIO()
+            await self.bot.db.export_members(ctx.guild.id, buffer)
+            buffer.seek(0)
+        await ctx.send(file=discord.File(buffer, filename=f"levels-{ctx.guild.id}.csv"))
+
     @commands.command()
     @commands.has_guild_permissions(manage_messages=True)
     async def giveexp(self, ctx: commands.Context, target: discord.Member, amount: int):
@@ -322,12 +726,14 @@ class LevelSystem(commands.Cog, name="Levelling"):
         else:
             target = target.id
 
-        try:
-            self._cache[ctx.guild.id].pop(target)
-        except KeyError:
-            pass
-        finally:
-            await self.bot.db.hakai_member(ctx.guild.id, target)
+        self.journal_reset(ctx.guild.id, target)
+        self._cache.remove(ctx.guild.id, target)
+        self.remove_from_leaderboard(ctx.guild.id, target)
+        await self.bot.db.hakai_member(ctx.guild.id, target)
+        # The birthday goes along with the row
+        birthdays = self.bot.get_cog('Birthday system')
+        if birthdays is not None:
+            birthdays.calendar.remove(ctx.guild.id, target)
 
     @commands.command(hidden=True)
     @commands.check(is_me)
@@ -336,8 +742,8 @@ class LevelSystem(commands.Cog, name="Levelling"):
         Command to update the database manually, mostly used for testing purposes, or when planning to take bot down
         for maintenance
         """
-        await self.update_level_db()
-        await ctx.send("db updated (hopefully)")
+        written = await self.flush_guilds()
+        await ctx.send(f"db updated (hopefully), {written} members written")
 
 
 def setup(bot: Zeta):
@@ -53,6 +53,20 @@ class Misc(commands.Cog):
         e.add_field(name="%age RAM used", value=f"{mem.percent}%")
         await ctx.send(embed=e)
 
+    @commands.command(hidden=True)
+    @commands.check(lambda ctx: ctx.author.id == 501451372147769355)
+    async def cycles(self, ctx: commands.Context):
+        """
+        Shows when the background loops last completed a cycle and how long it took
+        """
+        e = discord.Embed(title="Background loops",
+                          description=f"Using up to {self.bot.scheduler.max_connections} database connections",
+                          colour=discord.Colour.blue())
+        for name, timing in self.bot.scheduler.timings.items():
+            e.add_field(name=name,
+                        value=f"Started {timing.started_at.strftime('%H:%M:%S')} (UTC)\nTook {timing.seconds:.2f}s")
+        await ctx.send(embed=e)
+
     @commands.command()
     async def invite(self, ctx: commands.Context):
         """
@@ -1,27 +1,200 @@
+import re
+import util
+import asyncio
 import discord
 import datetime
+import collections
 from main import Zeta
 from typing import Union
 from discord.utils import get
 from discord.ext import commands, tasks
 
 
-async def create_mute_role(guild: discord.Guild):
-    """Creates a mute role in a guild, members having it can't send messages or add reactions"""
+async def create_mute_role(guild: discord.Guild, progress=None):
+    """
+    Creates a mute role in a guild, members having it can't send messages or add reactions
+
+    :param guild: The guild to create it in
+    :param progress: Optional coroutine function called with (channels done, total channels) as overwrites get applied
+    """
     perms = discord.Permissions.none()
     newrole = await guild.create_role(name="Muted", permissions=perms)
 
     ow = discord.PermissionOverwrite(send_messages=False, add_reactions=False)
 
-    for channel in guild.channels:
-        await channel.set_permissions(newrole, overwrite=ow)
+    # A few overwrites at a time instead of one after another
+    throttle = util.Throttle(concurrency=OVERWRITE_CONCURRENCY, retries=OVERWRITE_RETRIES)
+    results = await throttle.gather(lambda channel: channel.set_permissions(newrole, overwrite=ow), guild.channels,
+                                    progress)
+    for channel, error in zip(guild.channels, results):
+        if isinstance(error, Exception):
+            print(f"Couldn't set mute overwrite in {channel.id} of {guild.id}: {error!r}")
 
     return newrole
 
 
-# The database for mutes will be queried every this minutes
+# The database for mutes will be queried every this minutes, loading the mutes that end before the next query
 QUERY_INTERVAL_MINUTES = 30
 
+# Mutes that end together are lifted this many at a time
+UNMUTE_BATCH_SIZE = 25
+
+# Channel overwrites (mute role setup, lockdown, unlock) are applied this many at once, the pace beyond that is left
+# to Discord's rate limit headers which discord.py already follows, ones that still hit a 429 are retried up to
+# OVERWRITE_RETRIES times
+OVERWRITE_CONCURRENCY = 5
+OVERWRITE_RETRIES = 3
+
+# Seconds between edits of the mute role setup progress message
+PROGRESS_EDIT_SECONDS = 3
+
+# Infractions shown per page of the infractions command
+INFRACTIONS_PAGE_SIZE = 10
+
+# Bans/kicks of massban/masskick run this many at once, at most MASS_ACTION_RATE per MASS_ACTION_PER seconds, retrying
+# ones that still hit a 429 up to MASS_ACTION_RETRIES times
+MASS_ACTION_CONCURRENCY = 5
+MASS_ACTION_RATE = 20
+MASS_ACTION_PER = 10
+MASS_ACTION_RETRIES = 3
+
+# Seconds a moderator has to confirm a filtered massban/masskick
+MASS_ACTION_CONFIRM_SECONDS = 30
+
+
+# Messages younger than this can go through bulk delete, a few minutes short of Discord's 14 days to be on the safe side
+BULK_DELETE_MAX_AGE = datetime.timedelta(days=14) - datetime.timedelta(minutes=5)
+
+# Most messages a bulk delete takes
+BULK_DELETE_CHUNK = 100
+
+# Messages too old for bulk delete are deleted one by one, at most OLD_DELETE_RATE per OLD_DELETE_PER seconds
+OLD_DELETE_RATE = 5
+OLD_DELETE_PER = 5
+
+
+async def stream_purge(channel: discord.TextChannel, limit: int = None, check=None,
+                       before: datetime.datetime = None, after: datetime.datetime = None) -> int:
+    """
+    Deletes messages from a channel as they come in from its history, so a large purge only ever holds about one
+    chunk of messages in memory
+
+    Messages young enough go out through bulk delete in chunks of BULK_DELETE_CHUNK, older ones are queued up and
+    deleted one at a time within OLD_DELETE_RATE, the history only gets read further once the queue has room. If one of
+    those fails, the rest of them are skipped and the error is raised once the history has been gone through.
+
+    :param channel: The channel to purge
+    :param limit: The number of messages to search through, None for all of them
+    :param check: Optional function taking a message, only messages it returns True for get deleted
+    :param before: Only messages before this time (UTC) or message
+    :param after: Only messages after this time (UTC) or message
+    :return: The number of messages deleted
+    """
+    bulk_since = datetime.datetime.utcnow() - BULK_DELETE_MAX_AGE
+    throttle = util.Throttle(concurrency=1, rate=OLD_DELETE_RATE, per=OLD_DELETE_PER)
+    old = asyncio.Queue(maxsize=BULK_DELETE_CHUNK)
+    deleted = 0
+    failure = None
+
+    async def delete_old():
+        nonlocal deleted, failure
+        # Keeps taking messages off the queue even after a failed delete, so the history reader never gets stuck on it
+        while True:
+            message = await old.get()
+            if message is None:
+                return
+            if failure is not None:
+                continue
+            try:
+                async with throttle:
+                    await message.delete()
+                deleted += 1
+            except discord.NotFound:
+                pass
+            except discord.HTTPException as error:
+                failure = error
+
+    async def delete_chunk(chunk):
+        nonlocal deleted
+        await channel.delete_messages(chunk)
+        deleted += len(chunk)
+
+    worker = asyncio.get_event_loop().create_task(delete_old())
+    chunk = []
+    try:
+        async for message in channel.history(limit=limit, before=before, after=after, oldest_first=False):
+            if check is not None and not check(message):
+                continue
+            if message.created_at > bulk_since:
+                chunk.append(message)
+                if len(chunk) == BULK_DELETE_CHUNK:
+                    await delete_chunk(chunk)
+                    chunk = []
+            else:
+                await old.put(message)
+        if chunk:
+            await delete_chunk(chunk)
+        await old.put(None)
+        await worker
+    finally:
+        worker.cancel()
+    if failure is not None:
+        raise failure
+    return deleted
+
+
+def parsedate(date: str) -> datetime.datetime:
+    """Converts a string of the format YYYY-MM-DD or YYYY-MM-DD HH:MM (UTC) into a datetime"""
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(date.strip(), fmt)
+        except ValueError:
+            pass
+    raise commands.BadArgument(f"{date} isn't a date of the format YYYY-MM-DD or \"YYYY-MM-DD HH:MM\"")
+
+
+def _permission_flag(name: str) -> int:
+    permissions = discord.Permissions.none()
+    setattr(permissions, name, True)
+    return permissions.value
+
+
+# Permission name -> bit, for every permission that can be set in a channel overwrite, aliases like view_channel included
+CHANNEL_PERMISSIONS = {name: _permission_flag(name) for name in sorted(discord.PermissionOverwrite.VALID_NAMES)
+                       if _permission_flag(name) & discord.Permissions.all_channel().value}
+
+# Same but without the aliases, for listing what an overwrite sets
+CHANNEL_PERMISSION_FLAGS = [(name, _permission_flag(name)) for name in sorted(discord.PermissionOverwrite.PURE_FLAGS)
+                            if _permission_flag(name) & discord.Permissions.all_channel().value]
+
+VALID_PERMISSIONS_TEXT = "  ".join(f'`{name}`' for name in CHANNEL_PERMISSIONS)
+
+# Channels whose effective permissions are kept around for whocan
+PERMISSION_MATRIX_CHANNELS = 50
+
+# Members listed per page of whocan
+WHOCAN_PAGE_SIZE = 40
+
+
+def _permission_group(member: discord.Member, personal: set):
+    """
+    Members with the same roles have the same permissions in a channel, so they're worked out once per set of roles.
+    The owner and members with an overwrite of their own (`personal`) are a group of their own, keyed by their id.
+    """
+    if member.id in personal or member.id == member.guild.owner_id:
+        return member.id
+    return frozenset(role.id for role in member.roles)
+
+
+def overwrite_listing(channel: discord.abc.GuildChannel, allowed: bool) -> str:
+    """Lists the permissions every overwrite of a channel explicitly allows (or denies)"""
+    listing = ""
+    for target, ow in channel.overwrites.items():
+        value = ow.pair()[0 if allowed else 1].value
+        if value:
+            listing += f"**{target}**\n" + " ".join(f"`{name}`" for name, flag in CHANNEL_PERMISSION_FLAGS if value & flag) + "\n\n"
+    return listing
+
 
 # Converts a string of the format 1d 2h 3m into the equivalent number of minutes
 def parsetime(time: str):
@@ -45,7 +218,29 @@ class Moderation(commands.Cog):
     def __init__(self, bot: Zeta):
         self.bot = bot
         self._cache = {}
+
+        # guildid -> {memberid: number of infractions}, members without any aren't in there
+        self._infraction_counts = {}
+        self._infractions_loaded = asyncio.Event()
+        self.bot.loop.create_task(self.load_infraction_counts())
+
+        # channelid -> (ids of members with an overwrite of their own, {permission group: effective permission bits}),
+        # least recently used channel first, see _permission_group
+        self._permission_matrices = collections.OrderedDict()
+
+        # guildid -> id of the guild's mute role
+        self._mute_roles = {}
+        self.bot.loop.create_task(self.load_mute_roles())
+
+        # (guildid, memberid) -> mute end, every timed mute ending before the next poll is in here
+        self._unmutes = util.TimerHeap()
+        self._unmutes_changed = asyncio.Event()
         self.mute_poll.start()
+        self._unmute_task = self.bot.loop.create_task(self.unmute_loop())
+
+    def cog_unload(self):
+        self.mute_poll.cancel()
+        self._unmute_task.cancel()
 
     async def load_cache(self):
         """Loads cache for moderative actions, not in use currently but future plans involve this as requirement"""
@@ -53,6 +248,172 @@ class Moderation(commands.Cog):
         for guild in self.bot.guilds:
             self._cache[guild.id] = {}
 
+    async def load_mute_roles(self):
+        """Loads the mute role ids saved for guilds"""
+        async with self.bot.pool.acquire() as conn:
+            async with conn.transaction():
+                async for entry in conn.cursor("SELECT id, muterole FROM guilds WHERE muterole IS NOT NULL"):
+                    self._mute_roles[entry.get('id')] = entry.get('muterole')
+
+    async def load_infraction_counts(self):
+        """Counts everyone's infractions once, after that warn, infractions delete and infractions clear keep the counts
+        up to date"""
+        # Everything infractions related waits for this, so it keeps trying until it gets through
+        while True:
+            counts = {}
+            try:
+                async with self.bot.pool.acquire() as conn:
+                    async with conn.transaction():
+                        async for entry in conn.cursor("SELECT guildid, memberid, COUNT(*) FROM infractions GROUP BY guildid, memberid"):
+                            counts.setdefault(entry.get('guildid'), {})[entry.get('memberid')] = entry.get('count')
+                break
+            except Exception as error:
+                print(f"Loading infraction counts failed ({error!r}), retrying in 30 seconds")
+                await asyncio.sleep(30)
+        self._infraction_counts = counts
+        self._infractions_loaded.set()
+
+    def change_infraction_count(self, guildid: int, memberid: int, change: int) -> None:
+        """Adds to (or takes from) the cached number of infractions a member has"""
+        counts = self._infraction_counts.setdefault(guildid, {})
+        count = counts.get(memberid, 0) + change
+        if count > 0:
+            counts[memberid] = count
+        else:
+            counts.pop(memberid, None)
+
+    def get_mute_role(self, guild: discord.Guild):
+        """Returns the mute role of a guild, None if it doesn't have one (anymore)"""
+        return guild.get_role(self._mute_roles.get(guild.id, 0))
+
+    async def set_mute_role(self, guild: discord.Guild, role: discord.Role) -> None:
+        """Remembers a role as the mute role of a guild"""
+        self._mute_roles[guild.id] = role.id
+        await self.bot.pool.execute("UPDATE guilds SET muterole = $1 WHERE id = $2", role.id, guild.id)
+
+    async def setup_mute_role(self, guild: discord.Guild, ctx: commands.Context = None) -> discord.Role:
+        """
+        Finds the mute role of a guild, creating it if it doesn't have one yet and keeping ctx (if given) posted on
+        how far along that is
+        """
+        mr = self.get_mute_role(guild)
+        if mr:
+            return mr
+
+        # Guilds that got their mute role before the id was being saved
+        mr = get(guild.roles, name="Muted")
+        if not mr and ctx is None:
+            mr = await create_mute_role(guild)
+        elif not mr:
+            total = len(guild.channels)
+            message = await ctx.send(f"Server doesn't seem to have mute configured yet, stand by please. "
+                                     f"(0/{total} channels)")
+            last_edit = datetime.datetime.utcnow()
+
+            async def progress(done, total):
+                nonlocal last_edit
+                now = datetime.datetime.utcnow()
+                if (now - last_edit).total_seconds() >= PROGRESS_EDIT_SECONDS:
+                    last_edit = now
+                    # The progress message may have been deleted in the meantime, the setup goes on regardless
+                    try:
+                        await message.edit(content=f"Server doesn't seem to have mute configured yet, stand by please. "
+                                                   f"({done}/{total} channels)")
+                    except discord.HTTPException:
+                        pass
+
+            async with ctx.channel.typing():
+                mr = await create_mute_role(guild, progress)
+            try:
+                await message.edit(content=f"Configured mute successfully ({total}/{total} channels)")
+            except discord.HTTPException:
+                pass
+
+        await self.set_mute_role(guild, mr)
+        return mr
+
+    def permission_matrix(self, channel: discord.abc.GuildChannel) -> tuple:
+        """
+        Returns the effective permissions of a channel as (ids of members with an overwrite of their own,
+        {permission group: permission bits}), groups get filled in by effective_permissions as they come up and are
+        kept up to date by the listeners below until the channel falls out of the cache
+        """
+        matrix = self._permission_matrices.get(channel.id)
+        if matrix is not None:
+            self._permission_matrices.move_to_end(channel.id)
+            return matrix
+        personal = {target.id for target in channel.overwrites if isinstance(target, discord.Member)}
+        matrix = self._permission_matrices[channel.id] = (personal, {})
+        while len(self._permission_matrices) > PERMISSION_MATRIX_CHANNELS:
+            self._permission_matrices.popitem(last=False)
+        return matrix
+
+    def effective_permissions(self, channel: discord.abc.GuildChannel, member: discord.Member) -> int:
+        """Returns the permission bits a member effectively has in a channel, shared with everyone in their group"""
+        personal, groups = self.permission_matrix(channel)
+        group = _permission_group(member, personal)
+        value = groups.get(group)
+        if value is None:
+            value = groups[group] = channel.permissions_for(member).value
+        return value
+
+    def invalidate_permissions(self, guild: discord.Guild) -> None:
+        """Drops the permission matrices of every channel in a guild"""
+        for channel in guild.channels:
+            self._permission_matrices.pop(channel.id, None)
+
+    def forget_member_permissions(self, member: discord.Member) -> None:
+        """
+        Drops what was worked out for a member as a group of their own in the cached matrices of their guild, members in
+        a group of roles move to another group by themselves when their roles change
+        """
+        for channel in member.guild.channels:
+            matrix = self._permission_matrices.get(channel.id)
+            if matrix is not None:
+                matrix[1].pop(member.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after: discord.abc.GuildChannel):
+        self._permission_matrices.pop(after.id, None)
+        # Channels synced with a category change along with it
+        if isinstance(after, discord.CategoryChannel):
+            for channel in after.channels:
+                self._permission_matrices.pop(channel.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        self._permission_matrices.pop(channel.id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before, after: discord.Role):
+        if before.permissions != after.permissions or before.position != after.position:
+            self.invalidate_permissions(after.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: discord.Role):
+        self.invalidate_permissions(role.guild)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before, after: discord.Guild):
+        if before.owner_id != after.owner_id:
+            self.invalidate_permissions(after)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after: discord.Member):
+        if before.roles != after.roles:
+            self.forget_member_permissions(after)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member: discord.Member):
+        # Overwrites of members that weren't in the guild when a matrix was made aren't in its personal ids
+        for channel in member.guild.channels:
+            if channel.id in self._permission_matrices and not channel.overwrites_for(member).is_empty():
+                self._permission_matrices.pop(channel.id)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member: discord.Member):
+        self.forget_member_permissions(member)
+
     # ------------------------------------Moderative actions--------------------------------------------
 
     @commands.command()
@@ -61,10 +422,44 @@ class Moderation(commands.Cog):
         """
         Prevents `@everyone` from sending messages/reactions
         Note that you need to have the server permission "manage messages" to use this command
+
+        The permissions of `@everyone` and its overwrites in every text channel are saved first, `unlock` puts them back exactly as they were.
         """
-        await ctx.guild.default_role.edit(permissions=discord.Permissions(send_messages=False, add_reactions=False))
-        await ctx.send(
-            embed=discord.Embed(title="A server-wide lockdown is now in effect", colour=discord.Colour.red()))
+        guild = ctx.guild
+        everyone = guild.default_role
+        if await self.bot.pool.fetchval("SELECT guildid FROM lockdowns WHERE guildid = $1", guild.id):
+            return await ctx.send("A lockdown is already in effect, use `unlock` to lift it first")
+
+        # Snapshot first, if applying the lockdown fails halfway unlock can still put everything back
+        snapshot = []
+        for channel in guild.text_channels:
+            allow, deny = channel.overwrites_for(everyone).pair() if everyone in channel.overwrites else (None, None)
+            snapshot.append((guild.id, channel.id, allow.value if allow else None, deny.value if deny else None))
+        async with self.bot.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("INSERT INTO lockdowns (guildid, permissions, time) VALUES ($1, $2, $3)",
+                                   guild.id, everyone.permissions.value, datetime.datetime.utcnow())
+                await conn.copy_records_to_table('lockdown_overwrites', records=snapshot,
+                                                 columns=['guildid', 'channelid', 'allow', 'deny'])
+
+        permissions = discord.Permissions(everyone.permissions.value)
+        permissions.update(send_messages=False, add_reactions=False)
+
+        async def lock(channel):
+            ow = channel.overwrites_for(everyone)
+            ow.update(send_messages=False, add_reactions=False)
+            await channel.set_permissions(everyone, overwrite=ow)
+
+        async with ctx.channel.typing():
+            await everyone.edit(permissions=permissions)
+            throttle = util.Throttle(concurrency=OVERWRITE_CONCURRENCY, retries=OVERWRITE_RETRIES)
+            results = await throttle.gather(lock, guild.text_channels)
+
+        e = discord.Embed(title="A server-wide lockdown is now in effect", colour=discord.Colour.red())
+        failed = sum(isinstance(r, Exception) for r in results)
+        if failed:
+            e.description = f"Couldn't lock {failed} channels"
+        await ctx.send(embed=e)
 
     @commands.command()
     @commands.has_guild_permissions(manage_messages=True)
@@ -72,10 +467,44 @@ class Moderation(commands.Cog):
         """
         Reenables `@everyone` to send messages/reactions
 
-        Basically reverses what the lockdown command does
+        Basically reverses what the lockdown command does, `@everyone`'s permissions and channel overwrites are restored to what they were before the lockdown
         Note that you need to have the server permission "manage messages" to use this command
         """
-        await ctx.guild.default_role.edit(permissions=discord.Permissions.general())
+        guild = ctx.guild
+        everyone = guild.default_role
+        permissions = await self.bot.pool.fetchval("SELECT permissions FROM lockdowns WHERE guildid = $1", guild.id)
+        if permissions is None:
+            # Lockdowns from before snapshots were saved, nothing to go on but the defaults
+            await everyone.edit(permissions=discord.Permissions.general())
+            return await ctx.send(
+                embed=discord.Embed(title="Lockdown lifted", description="No snapshot was saved, `@everyone` was reset to the default permissions",
+                                    colour=discord.Colour.green()))
+
+        overwrites = await self.bot.pool.fetch("SELECT channelid, allow, deny FROM lockdown_overwrites WHERE guildid = $1",
+                                               guild.id)
+
+        async def restore(entry):
+            channel = guild.get_channel(entry.get('channelid'))
+            if channel is None:
+                return
+            if entry.get('allow') is None:
+                await channel.set_permissions(everyone, overwrite=None)
+            else:
+                await channel.set_permissions(everyone, overwrite=discord.PermissionOverwrite.from_pair(
+                    discord.Permissions(entry.get('allow')), discord.Permissions(entry.get('deny'))))
+
+        async with ctx.channel.typing():
+            await everyone.edit(permissions=discord.Permissions(permissions))
+            throttle = util.Throttle(concurrency=OVERWRITE_CONCURRENCY, retries=OVERWRITE_RETRIES)
+            results = await throttle.gather(restore, overwrites)
+
+        failed = sum(isinstance(r, Exception) for r in results)
+        if failed:
+            # Keep the snapshot so unlock can be tried again
+            return await ctx.send(embed=discord.Embed(title="Lockdown partly lifted",
+                                                      description=f"Couldn't restore {failed} channels, try `unlock` again",
+                                                      colour=discord.Colour.red()))
+        await self.bot.pool.execute("DELETE FROM lockdowns WHERE guildid = $1", guild.id)
         await ctx.send(
             embed=discord.Embed(title="Lockdown lifted", colour=discord.Colour.green()))
 
@@ -90,39 +519,58 @@ class Moderation(commands.Cog):
         Setting the time to `1d 2h 4m` would mute your target for 1 day, 2 hours and 4 minutes
         Note that you need to have the server permission "manage messages" to use this command
         """
-        mr = get(ctx.guild.roles, name="Muted")
-        if not mr:
-            await ctx.send("Server doesn't seem to have mute configured yet, stand by please.")
-            async with ctx.channel.typing():
-                mr = await create_mute_role(ctx.guild)
-                await ctx.send("Configured mute successfully")
+        await self.setup_mute_role(ctx.guild, ctx)
+        muted_till = await self.mute_member(target, parsetime(time) if time else None)
 
-        if not time:
-            await target.add_roles(mr)
+        if muted_till is None:
             e = discord.Embed(description=f"{target} has been muted", colour=discord.Colour.red())
-            e1 = discord.Embed(description=f"You have been muted from the server {ctx.guild} indefinitely, you'll only"
-                                           f"be able to send messages if a moderator unmutes you",
-                               colour=discord.Colour.red())
-            await ctx.send(embed=e)
-            await target.send(embed=e1)
+        else:
+            e = discord.Embed(description=f"{target} has been muted till {muted_till}", colour=discord.Colour.red())
+        await ctx.send(embed=e)
 
-        if time:
-            await target.add_roles(mr)
+    async def mute_member(self, target: discord.Member, duration: int = None, reason: str = None):
+        """
+        Mutes a member and lets them know, the mute command and anything else muting people go through this
 
-            duration = parsetime(time)
-            muted_till = datetime.datetime.utcnow() + datetime.timedelta(minutes=duration)
+        :param target: The member to mute
+        :param duration: Minutes to mute them for, None to mute them until someone unmutes them
+        :param reason: Optional reason that's told to the member
+        :return: The time (UTC) the mute ends at, None for an indefinite mute
+        """
+        guild = target.guild
+        mr = await self.setup_mute_role(guild)
+        await target.add_roles(mr)
 
-            await self.bot.pool.execute("INSERT INTO mutes (id, guildid, mutedtill) VALUES ($1, $2, $3)",
-                                        target.id, ctx.guild.id, muted_till)
+        # A member only ever has one mute, a new one replaces whatever was left of the old one, scheduled unmute included
+        self._unmutes.cancel((guild.id, target.id))
 
-            e = discord.Embed(description=f"{target} has been muted till {muted_till}", colour=discord.Colour.red())
-            e1 = discord.Embed(description=f"You have been muted from the server {ctx.guild} for {muted_till} (UTC)",
+        if duration is None:
+            muted_till = None
+            await self.bot.pool.execute("DELETE FROM mutes WHERE id = $1 AND guildid = $2", target.id, guild.id)
+            e1 = discord.Embed(description=f"You have been muted from the server {guild} indefinitely, you'll only"
+                                           f"be able to send messages if a moderator unmutes you",
                                colour=discord.Colour.red())
-            await ctx.send(embed=e)
-            await target.send(embed=e1)
+        else:
+            muted_till = datetime.datetime.utcnow() + datetime.timedelta(minutes=duration)
 
+            async with self.bot.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute("DELETE FROM mutes WHERE id = $1 AND guildid = $2", target.id, guild.id)
+                    await conn.execute("INSERT INTO mutes (id, guildid, mutedtill) VALUES ($1, $2, $3)",
+                                       target.id, guild.id, muted_till)
             if duration < QUERY_INTERVAL_MINUTES:
-                self.bot.loop.create_task(self.perform_unmute(ctx.guild.id, target.id, muted_till))
+                self.schedule_unmute(guild.id, target.id, muted_till)
+
+            e1 = discord.Embed(description=f"You have been muted from the server {guild} for {muted_till} (UTC)",
+                               colour=discord.Colour.red())
+
+        if reason:
+            e1.add_field(name="Reason", value=reason)
+        try:
+            await target.send(embed=e1)
+        except discord.Forbidden:
+            pass
+        return muted_till
 
     @commands.command()
     @commands.has_guild_permissions(manage_messages=True)
@@ -133,7 +581,9 @@ class Moderation(commands.Cog):
         target here is the member you wish to unmute, note that unmuting a member with a timed mute will end their mute period at that instant
         Note that you need to have the server permission "manage messages" to use this command
         """
-        await self.perform_unmute(ctx.guild.id, target.id, datetime.datetime.utcnow())
+        self._unmutes.cancel((ctx.guild.id, target.id))
+        await self.perform_unmute(ctx.guild.id, target.id)
+        await self.bot.pool.execute("DELETE FROM mutes WHERE id = $1 AND guildid = $2", target.id, ctx.guild.id)
         await ctx.send(embed=discord.Embed(description=f"Unmuted {target.mention}", colour=discord.Colour.green()))
 
     @commands.command()
@@ -158,51 +608,246 @@ class Moderation(commands.Cog):
         await target.ban(reason=reason)
         await ctx.send(embed=discord.Embed(description=f"{target.mention} was banned"))
 
-    async def perform_unmute(self, guildid, targetid, when: datetime.datetime):
-        """Unmutes a target in a guild at a specified time"""
+    async def mass_action(self, ctx: commands.Context, action: str, targets: list, reason: str = None):
+        """
+        Bans or kicks a bunch of users concurrently within rate limits, then sends a single summary of how it went
+
+        :param ctx: Context of the massban/masskick command
+        :param action: Either 'ban' or 'kick'
+        :param targets: Users to act on, discord.Object works for bans of users that aren't in the guild
+        :param reason: Reason that goes in the audit log
+        """
+        # Never the moderator themselves or the bot, and only members below the moderator unless they own the server
+        targets = [t for t in targets if t.id not in (ctx.author.id, ctx.guild.me.id)]
+        skipped = []
+        if ctx.author.id != ctx.guild.owner_id:
+            below = []
+            for target in targets:
+                member = ctx.guild.get_member(target.id)
+                if member is not None and member.top_role >= ctx.author.top_role:
+                    skipped.append(target)
+                else:
+                    below.append(target)
+            targets = below
+        if not targets:
+            extra = f", {len(skipped)} skipped for having a role at or above yours" if skipped else ""
+            return await ctx.send(f"Nobody to {action}{extra}")
+
+        reason = f"{ctx.author} (mass{action}): {reason}" if reason else f"{ctx.author} (mass{action})"
+        if action == 'ban':
+            func = lambda target: ctx.guild.ban(target, reason=reason, delete_message_days=0)
+        else:
+            func = lambda target: ctx.guild.kick(target, reason=reason)
+
+        throttle = util.Throttle(concurrency=MASS_ACTION_CONCURRENCY, rate=MASS_ACTION_RATE, per=MASS_ACTION_PER,
+                                 retries=MASS_ACTION_RETRIES)
+        async with ctx.channel.typing():
+            results = await throttle.gather(func, targets)
+
+        done = [t for t, r in zip(targets, results) if not isinstance(r, Exception)]
+        forbidden = [t for t, r in zip(targets, results) if isinstance(r, discord.Forbidden)]
+        not_found = [t for t, r in zip(targets, results) if isinstance(r, discord.NotFound)]
+        failed = len(targets) - len(done) - len(forbidden) - len(not_found)
+
+        e = discord.Embed(title=f"Mass{action} finished",
+                          description=f"{'Banned' if action == 'ban' else 'Kicked'} {len(done)} of {len(targets)}",
+                          colour=discord.Colour.green() if len(done) == len(targets) and not skipped else discord.Colour.red())
+        if skipped:
+            e.add_field(name="Skipped (role at or above yours)", value=str(len(skipped)))
+        if forbidden:
+            e.add_field(name="Missing permissions for", value=f"{len(forbidden)} (roles above mine?)")
+        if not_found:
+            e.add_field(name="Unknown users", value=str(len(not_found)))
+        if failed:
+            e.add_field(name="Failed", value=str(failed))
+        await ctx.send(embed=e)
+
+    async def confirm_mass_action(self, ctx: commands.Context, action: str, targets: list) -> bool:
+        """
+        Shows who a filtered massban/masskick matched and waits for the moderator to confirm it with a reaction
+        """
+        if not targets:
+            await ctx.send("No members matched")
+            return False
+        shown = ", ".join(str(t) for t in targets[:20]) + (f" and {len(targets) - 20} more" if len(targets) > 20 else "")
+        message = await ctx.send(embed=discord.Embed(
+            title=f"{action.capitalize()} {len(targets)} members?",
+            description=f"{shown}\n\nReact with \u2705 within {MASS_ACTION_CONFIRM_SECONDS} seconds to confirm",
+            colour=discord.Colour.red()))
+        await message.add_reaction('\u2705')
+        try:
+            await self.bot.wait_for('reaction_add', timeout=MASS_ACTION_CONFIRM_SECONDS,
+                                    check=lambda r, u: r.message.id == message.id and u == ctx.author and str(r.emoji) == '\u2705')
+        except asyncio.TimeoutError:
+            await ctx.send(f"Mass{action} cancelled")
+            return False
+        return True
+
+    @staticmethod
+    def members_joined_within(guild: discord.Guild, minutes: int) -> list:
+        """Returns the members of a guild that joined in the last so many minutes"""
+        since = datetime.datetime.utcnow() - datetime.timedelta(minutes=minutes)
+        return [m for m in guild.members if m.joined_at and m.joined_at >= since]
+
+    @staticmethod
+    def members_matching(guild: discord.Guild, pattern: str) -> list:
+        """Returns the members of a guild whose username or nickname matches a regex, raises re.error if it's invalid"""
+        regex = re.compile(pattern, re.IGNORECASE)
+        return [m for m in guild.members if regex.search(m.name) or (m.nick and regex.search(m.nick))]
+
+    @commands.group(invoke_without_command=True)
+    @commands.has_guild_permissions(ban_members=True)
+    async def massban(self, ctx: commands.Context, targets: commands.Greedy[int], *, reason: str = None):
+        """
+        Bans many users at once, they don't have to be in the server
+
+        `targets` here are the ids of the users you'd like to ban, separated by spaces.
+        `reason` (optional) is the reason that goes in the audit log.
+        Use `massban joined` or `massban name` to ban members matching a filter instead.
+        Note that you need the server permission "ban members" to use this command.
+        """
+        await self.mass_action(ctx, 'ban', [discord.Object(id=i) for i in dict.fromkeys(targets)], reason)
+
+    @massban.command(name='joined')
+    @commands.has_guild_permissions(ban_members=True)
+    async def massban_joined(self, ctx: commands.Context, minutes: int, *, reason: str = None):
+        """
+        Bans every member that joined in the last `minutes` minutes, after you confirm it
+        """
+        targets = self.members_joined_within(ctx.guild, minutes)
+        if await self.confirm_mass_action(ctx, 'ban', targets):
+            await self.mass_action(ctx, 'ban', targets, reason)
+
+    @massban.command(name='name')
+    @commands.has_guild_permissions(ban_members=True)
+    async def massban_name(self, ctx: commands.Context, pattern: str, *, reason: str = None):
+        """
+        Bans every member whose username or nickname matches the regex `pattern` (case insensitive), after you confirm it
+
+        Put the pattern in quotes if it has spaces in it.
+        """
+        try:
+            targets = self.members_matching(ctx.guild, pattern)
+        except re.error as error:
+            return await ctx.send(f"Invalid regex: {error}")
+        if await self.confirm_mass_action(ctx, 'ban', targets):
+            await self.mass_action(ctx, 'ban', targets, reason)
+
+    @commands.group(invoke_without_command=True)
+    @commands.has_guild_permissions(kick_members=True)
+    async def masskick(self, ctx: commands.Context, targets: commands.Greedy[discord.Member], *, reason: str = None):
+        """
+        Kicks many members at once
+
+        `targets` here are the members you'd like to kick, mentions or ids separated by spaces.
+        `reason` (optional) is the reason that goes in the audit log.
+        Use `masskick joined` or `masskick name` to kick members matching a filter instead.
+        Note that you need the server permission "kick members" to use this command.
+        """
+        await self.mass_action(ctx, 'kick', list({t.id: t for t in targets}.values()), reason)
+
+    @masskick.command(name='joined')
+    @commands.has_guild_permissions(kick_members=True)
+    async def masskick_joined(self, ctx: commands.Context, minutes: int, *, reason: str = None):
+        """
+        Kicks every member that joined in the last `minutes` minutes, after you confirm it
+        """
+        targets = self.members_joined_within(ctx.guild, minutes)
+        if await self.confirm_mass_action(ctx, 'kick', targets):
+            await self.mass_action(ctx, 'kick', targets, reason)
+
+    @masskick.command(name='name')
+    @commands.has_guild_permissions(kick_members=True)
+    async def masskick_name(self, ctx: commands.Context, pattern: str, *, reason: str = None):
+        """
+        Kicks every member whose username or nickname matches the regex `pattern` (case insensitive), after you confirm it
+
+        Put the pattern in quotes if it has spaces in it.
+        """
+        try:
+            targets = self.members_matching(ctx.guild, pattern)
+        except re.error as error:
+            return await ctx.send(f"Invalid regex: {error}")
+        if await self.confirm_mass_action(ctx, 'kick', targets):
+            await self.mass_action(ctx, 'kick', targets, reason)
+
+    async def perform_unmute(self, guildid, targetid):
+        """Unmutes a target in a guild, if they're still in it and still muted"""
 
         # Gotta get the guild and member objects to perform the unmute
         guild = self.bot.get_guild(guildid)
-        target = guild.get_member(targetid)
-
-        # Neat little feature to sleep till a specified timestamp in UTC
-        await discord.utils.sleep_until(when)
+        target = guild.get_member(targetid) if guild else None
 
         # This checks if the target left the server because angry on being muted
         if target:
-            # Remove the muted role, currently using get, in the near future might just save the muted role ids into
-            # the database
-            role = get(guild.roles, name='Muted')
+            # The name lookup is only for guilds whose mute role predates the id being saved
+            role = self.get_mute_role(guild) or get(guild.roles, name='Muted')
 
             # Checks if member was already unmuted manually in which case no need to send the message
-            if role in target.roles:
+            if role and role in target.roles:
                 await target.remove_roles(role)
 
                 # Send a message to the target informing them that they were unmuted
                 e = discord.Embed(
                     description=f"Your mute period has been completed, you will now be able to send messages in "
                                 f"{guild} again.", colour=discord.Colour.green())
-                await target.send(embed=e)
+                try:
+                    await target.send(embed=e)
+                except discord.Forbidden:
+                    pass
+
+    def schedule_unmute(self, guildid: int, targetid: int, when: datetime.datetime) -> None:
+        """Schedules a member to be unmuted at a specified time in UTC, replacing any unmute already scheduled for them"""
+        self._unmutes.push((guildid, targetid), when)
+        self._unmutes_changed.set()
+
+    async def unmute_loop(self):
+        """
+        Background task that sleeps until the earliest scheduled unmute (or until an earlier one gets scheduled) and
+        then lifts every mute that has ended, in batches
+        """
+        await self.bot.wait_until_ready()
+        while True:
+            due = self._unmutes.pop_due(datetime.datetime.utcnow())
+            for start in range(0, len(due), UNMUTE_BATCH_SIZE):
+                batch = due[start:start + UNMUTE_BATCH_SIZE]
+                results = await asyncio.gather(*[self.perform_unmute(guildid, targetid)
+                                                 for (guildid, targetid), _, _ in batch], return_exceptions=True)
+                for error in results:
+                    if isinstance(error, Exception):
+                        print(f"Couldn't lift a mute: {error!r}")
+                # Only the mutes that actually ended get deleted, in case a member got muted again meanwhile, if this
+                # fails the rows stay and the next poll schedules them again
+                try:
+                    await self.bot.pool.execute("DELETE FROM mutes WHERE (guildid, id) IN "
+                                                "(SELECT * FROM unnest($1::bigint[], $2::bigint[])) AND mutedtill <= $3",
+                                                [guildid for (guildid, _), _, _ in batch],
+                                                [targetid for (_, targetid), _, _ in batch],
+                                                max(when for _, when, _ in batch))
+                except Exception as error:
+                    print(f"Couldn't delete lifted mutes: {error!r}")
 
-        # Gotta delete the entry from the database now that the unmute has been done
-        await self.bot.pool.execute("DELETE FROM mutes WHERE id = $1 AND guildid = $2",
-                                    targetid, guildid)
+            self._unmutes_changed.clear()
+            earliest = self._unmutes.peek()
+            timeout = None if earliest is None else max((earliest - datetime.datetime.utcnow()).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self._unmutes_changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
     @tasks.loop(minutes=QUERY_INTERVAL_MINUTES)
     async def mute_poll(self):
         """Background loop that takes care of querying the databse and looking up entries where the time till
-        a target has been muted for is before the time the next iteration of the loop will happen."""
+        a target has been muted for is before the time the next iteration of the loop will happen, those get put in
+        the unmute timer heap."""
         await self.bot.wait_until_ready()
-        async with self.bot.pool.acquire() as conn:
-            async with conn.transaction():
-                future = datetime.datetime.utcnow() + datetime.timedelta(minutes=QUERY_INTERVAL_MINUTES)
-                async for entry in conn.cursor("SELECT * FROM mutes WHERE mutedtill < $1",
-                                               future):
-                    # Creating an async task to perform unmutes, the future handling is done in the perform_unmute
-                    # function itself
-                    self.bot.loop.create_task(self.perform_unmute(entry.get('guildid'),
-                                                                  entry.get('id'),
-                                                                  entry.get('mutedtill')))
+        async with self.bot.scheduler.cycle('mute poll'), self.bot.scheduler.connection_slot():
+            future = datetime.datetime.utcnow() + datetime.timedelta(minutes=QUERY_INTERVAL_MINUTES)
+            # Range scan on the mutes_mutedtill index
+            for entry in await self.bot.pool.fetch("SELECT id, guildid, mutedtill FROM mutes WHERE mutedtill < $1",
+                                                   future):
+                self._unmutes.push((entry.get('guildid'), entry.get('id')), entry.get('mutedtill'))
+            self._unmutes_changed.set()
 
     @commands.command()
     @commands.has_guild_permissions(manage_messages=True)
@@ -215,25 +860,41 @@ class Moderation(commands.Cog):
 
         This warning gets added to the member's infractions, use the `infractions` command to learn more.
         """
-        await self.bot.pool.execute("INSERT INTO infractions (guildid, memberid, reason, time) VALUES ($1, $2, $3, $4)",
-                                    ctx.guild.id, target.id, reason, datetime.datetime.utcnow())
+        await self.warn_member(target, reason)
         await ctx.send(embed=discord.Embed(description=f"{target.mention} was warned", colour=self.bot.Colour.red()))
 
+    async def warn_member(self, target: discord.Member, reason: str) -> None:
+        """Adds a warning to a member's infractions, the warn command and anything else warning people go through this"""
+        await self._infractions_loaded.wait()
+        await self.bot.pool.execute("INSERT INTO infractions (guildid, memberid, reason, time) VALUES ($1, $2, $3, $4)",
+                                    target.guild.id, target.id, reason, datetime.datetime.utcnow())
+        self.change_infraction_count(target.guild.id, target.id, 1)
+
     @commands.group(invoke_without_command=True, aliases=['infraction'])
     @commands.has_guild_permissions(manage_messages=True)
-    async def infractions(self, ctx: commands.Context, target: discord.Member):
+    async def infractions(self, ctx: commands.Context, target: discord.Member, page: int = 1):
         """
-        Used to see a member's infractions
+        Used to see a member's infractions, newest first
 
         `target` here is the member whose infractions you wish to see, can be mention, id or username.
+        `page` (optional) is the page of infractions to start at, defaults to the first one.
         """
-        async with self.bot.pool.acquire() as conn:
-            async with conn.transaction():
-                embed = discord.Embed(title=f"Infractions for {target}", description="\n\n".join([f"(ID: **{record.get('id')}**), [{record.get('time').strftime('%d/%m/%Y') if record.get('time') else None}]\nReason: {record.get('reason')}" async for record in conn.cursor("SELECT id, reason, time FROM infractions WHERE memberid = $1 AND guildid = $2", target.id, ctx.guild.id)]), colour=discord.Colour.red())
-                if not embed.description:
-                    await ctx.send(f"{target} doesn't have any infractions")
-                else:
-                    await ctx.send(embed=embed)
+        await self._infractions_loaded.wait()
+        count = self._infraction_counts.get(ctx.guild.id, {}).get(target.id, 0)
+        if not count:
+            return await ctx.send(f"{target} doesn't have any infractions")
+        pages = -(-count // INFRACTIONS_PAGE_SIZE)
+
+        async def get_page(number):
+            # Served by the infractions_member index
+            records = await self.bot.pool.fetch("SELECT id, reason, time FROM infractions WHERE guildid = $1 AND memberid = $2 "
+                                                "ORDER BY time DESC, id DESC LIMIT $3 OFFSET $4",
+                                                ctx.guild.id, target.id, INFRACTIONS_PAGE_SIZE, number * INFRACTIONS_PAGE_SIZE)
+            embed = discord.Embed(title=f"Infractions for {target}", description="\n\n".join([f"(ID: **{record.get('id')}**), [{record.get('time').strftime('%d/%m/%Y') if record.get('time') else None}]\nReason: {record.get('reason')}" for record in records]), colour=discord.Colour.red())
+            embed.set_footer(text=f"Page {number + 1}/{pages}, {count} total")
+            return embed
+
+        await util.EmbedPaginator(self.bot, ctx, get_page, pages, user=ctx.author).start(min(max(page, 1), pages) - 1)
 
     @infractions.command()
     @commands.has_guild_permissions(manage_messages=True)
@@ -243,10 +904,13 @@ class Moderation(commands.Cog):
 
         `infraction_id` here is the id of the **infraction** you wish to delete, the id of the infraction can be obtained by using the `infractions` command
         """
-        rc = await self.bot.pool.execute("DELETE FROM infractions WHERE id = $1 AND guildid = $2", infraction_id, ctx.guild.id)
-        if rc != 'DELETE 1':
+        await self._infractions_loaded.wait()
+        memberid = await self.bot.pool.fetchval("DELETE FROM infractions WHERE id = $1 AND guildid = $2 RETURNING memberid",
+                                                infraction_id, ctx.guild.id)
+        if memberid is None:
             await ctx.send("Couldn't remove infraction, double check the id provided")
         else:
+            self.change_infraction_count(ctx.guild.id, memberid, -1)
             await ctx.send("Infraction deleted successfully!")
 
     @infractions.command()
@@ -257,18 +921,81 @@ class Moderation(commands.Cog):
 
         `target` here is the member whose infractions you wish to clear, can be mention, id or username. Note that this command will remove **all** infractions `target` has.
         """
+        await self._infractions_loaded.wait()
         await self.bot.pool.execute("DELETE FROM infractions WHERE guildid = $1 AND memberid = $2", ctx.guild.id, target.id)
+        self._infraction_counts.get(ctx.guild.id, {}).pop(target.id, None)
         await ctx.send(f"{target}'s infractions were cleared successfully")
 
-    @commands.command()
+    @commands.group(invoke_without_command=True)
     @commands.has_permissions(manage_messages=True)
     async def purge(self, ctx: commands.Context, amount: int):
         """
         Bulk deletes a set amount of messages
 
         `amount` is the number of messages you wish to delete (including the command itself)
+        Use the subcommands `user`, `match`, `attachments` and `range` to only delete some of them, messages older than two weeks get deleted too, only slower.
+        """
+        await stream_purge(ctx.channel, limit=amount+1)
+
+    async def filtered_purge(self, ctx: commands.Context, limit: int = None, check=None, before=None, after=None):
+        """Purges ctx's channel, leaving the command itself to be deleted last, and reports how many messages went"""
+        async with ctx.channel.typing():
+            deleted = await stream_purge(ctx.channel, limit=limit, check=check, before=before or ctx.message, after=after)
+        try:
+            await ctx.message.delete()
+        except discord.NotFound:
+            pass
+        await ctx.send(embed=discord.Embed(description=f"Deleted {deleted} messages", colour=discord.Colour.green()),
+                       delete_after=5)
+
+    @purge.command(name='user')
+    @commands.has_permissions(manage_messages=True)
+    async def purge_user(self, ctx: commands.Context, target: discord.User, limit: int):
+        """
+        Deletes messages sent by a user
+
+        `target` here is the user whose messages you wish to delete, can be mention, id or username.
+        `limit` is the number of messages you wish to search through.
+        """
+        await self.filtered_purge(ctx, limit, lambda m: m.author.id == target.id)
+
+    @purge.command(name='match')
+    @commands.has_permissions(manage_messages=True)
+    async def purge_match(self, ctx: commands.Context, pattern: str, limit: int):
+        """
+        Deletes messages whose content matches a regex
+
+        `pattern` here is the regex (case insensitive), put it in quotes if it has spaces in it.
+        `limit` is the number of messages you wish to search through.
+        """
+        try:
+            regex = re.compile(pattern, re.IGNORECASE)
+        except re.error as error:
+            return await ctx.send(f"Invalid regex: {error}")
+        await self.filtered_purge(ctx, limit, lambda m: regex.search(m.content) is not None)
+
+    @purge.command(name='attachments', aliases=['files'])
+    @commands.has_permissions(manage_messages=True)
+    async def purge_attachments(self, ctx: commands.Context, limit: int):
         """
-        await ctx.channel.purge(limit=amount+1)
+        Deletes messages that have attachments
+
+        `limit` is the number of messages you wish to search through.
+        """
+        await self.filtered_purge(ctx, limit, lambda m: bool(m.attachments))
+
+    @purge.command(name='range')
+    @commands.has_permissions(manage_messages=True)
+    async def purge_range(self, ctx: commands.Context, start: parsedate, end: parsedate = None):
+        """
+        Deletes every message sent between two times (UTC)
+
+        `start` and `end` are of the format YYYY-MM-DD or "YYYY-MM-DD HH:MM" (with the quotes), leave out `end` to delete everything since `start`.
+        For example `purge range 2021-03-01 "2021-03-02 18:30"`
+        """
+        if end is not None and end <= start:
+            return await ctx.send("`end` has to be after `start`")
+        await self.filtered_purge(ctx, before=end, after=start)
 
     @commands.command()
     @commands.has_permissions(manage_messages=True)
@@ -278,7 +1005,7 @@ class Moderation(commands.Cog):
 
         `limit` is the number of messages you wish to search through, setting it to 50 for example would mean bot searches through last 50 messages sent in the channel and deletes the ones created by bots.
         """
-        await ctx.channel.purge(limit=limit, check=lambda m: m.author.bot)
+        await stream_purge(ctx.channel, limit=limit, check=lambda m: m.author.bot)
 
     @commands.command(name='user-info', aliases=['userinfo'])
     @commands.has_guild_permissions(kick_members=True)
@@ -290,7 +1017,8 @@ class Moderation(commands.Cog):
         e.add_field(name=f"Roles", value=" ".join([str(r) for r in target.roles]))
         e.add_field(name="Joined at", value=target.joined_at.strftime('%d %B %Y'))
         e.add_field(name='User ID', value=str(target.id))
-        infcount = (await self.bot.pool.fetchrow('SELECT COUNT(*) FROM infractions WHERE guildid = $1 AND memberid = $2', ctx.guild.id, target.id)).get('count')
+        await self._infractions_loaded.wait()
+        infcount = self._infraction_counts.get(ctx.guild.id, {}).get(target.id, 0)
         e.add_field(name="Server infractions", value=f"{infcount} total")
         e.add_field(name='Permissions', value=" ".join([f"`{str(p)}`" for p, val in target.guild_permissions if val is True]), inline=False)
         await ctx.send(embed=e)
@@ -309,21 +1037,12 @@ class Moderation(commands.Cog):
         would give a list of all the members/roles that have the permission `manage_messages` in the channel `general`
         """
         permission = permission.lower()
-        guildperms = [str(p) for p, val in discord.Permissions.all_channel() if val is False]
-        ignoredattrs = [
-                           'PURE_FLAGS',
-                           'VALID_NAMES',
-                           'is_empty',
-                           'pair',
-                       ] + guildperms
-        valid_perms = "  ".join([f'`{str(p)}`' for p in dir(discord.PermissionOverwrite) if
-                                 not p.startswith('_') and str(p) not in ignoredattrs])
-
-        if permission not in valid_perms or permission not in dir(discord.Permissions):
-            return await ctx.send("Invalid permission entered, here's an alphabetical list of valid permission types: "+"\n"+valid_perms)
+        if permission not in CHANNEL_PERMISSIONS:
+            return await ctx.send("Invalid permission entered, here's an alphabetical list of valid permission types: "+"\n"+VALID_PERMISSIONS_TEXT)
+        flag = CHANNEL_PERMISSIONS[permission]
 
         e = discord.Embed(title=f"Members/Roles with {permission} permission in {channel}:",
-                          description=" ".join([t.mention if getattr(ow, permission) is True else "" for t, ow in channel.overwrites.items()]),
+                          description=" ".join([t.mention for t, ow in channel.overwrites.items() if ow.pair()[0].value & flag]),
                           colour=discord.Colour.dark_blue())
         if not e.description.strip():
             return await ctx.send(f"No roles/members have the overwrite {permission} explicitly set to **Allow** in {channel}")
@@ -337,15 +1056,8 @@ class Moderation(commands.Cog):
 
         `channel` here is the channel you wish to see the explicitly allowed overwrites for, can be mention, id, or username.
         """
-        e = discord.Embed(title=f"Explicitly allowed overwrites for {channel}:", description="", colour=discord.Colour.red())
-        for k, v in channel.overwrites.items():
-            temp = f"**{str(k)}**" + "\n"
-            for p, val in v:
-                if val is True:
-                    temp += f"`{str(p)}` "
-            if temp == f"**{str(k)}**" + "\n":
-                temp = ""
-            e.description += temp + "\n\n"
+        e = discord.Embed(title=f"Explicitly allowed overwrites for {channel}:", description=overwrite_listing(channel, True),
+                          colour=discord.Colour.red())
 
         await ctx.send(embed=e)
 
@@ -357,18 +1069,40 @@ class Moderation(commands.Cog):
 
         `channel` here is the channel you wish to see the explicitly denied overwrites for, can be mention, id, or username.
         """
-        e = discord.Embed(title=f"Explicitly allowed overwrites for {channel}:", description="",
+        e = discord.Embed(title=f"Explicitly denied overwrites for {channel}:", description=overwrite_listing(channel, False),
                           colour=discord.Colour.red())
-        for k, v in channel.overwrites.items():
-            temp = f"**{str(k)}**" + "\n"
-            for p, val in v:
-                if val is False:
-                    temp += f"`{str(p)}` "
-            if temp == f"**{str(k)}**" + "\n":
-                temp = ""
-            e.description += temp + "\n\n"
 
         await ctx.send(embed=e)
 
+    @commands.command()
+    @commands.has_guild_permissions(manage_roles=True)
+    async def whocan(self, ctx: commands.Context, permission: str, channel: Union[discord.TextChannel, discord.VoiceChannel, discord.CategoryChannel] = None):
+        """
+        Lists every member that effectively has a permission in a channel, after roles and overwrites are taken into account
+
+        `permission` here is the permission you wish to check, for example `send_messages`.
+        `channel` (optional) is the channel to check it in, defaults to the channel the command is used in.
+        """
+        channel = channel or ctx.channel
+        permission = permission.lower()
+        if permission not in CHANNEL_PERMISSIONS:
+            return await ctx.send("Invalid permission entered, here's an alphabetical list of valid permission types: "+"\n"+VALID_PERMISSIONS_TEXT)
+        flag = CHANNEL_PERMISSIONS[permission]
+
+        members = [m.id for m in channel.guild.members if self.effective_permissions(channel, m) & flag]
+        if not members:
+            return await ctx.send(f"Nobody has the permission {permission} in {channel}")
+        pages = -(-len(members) // WHOCAN_PAGE_SIZE)
+
+        async def get_page(number):
+            e = discord.Embed(title=f"Members with {permission} permission in {channel}:",
+                              description=" ".join(f"<@{memberid}>" for memberid in
+                                                   members[number * WHOCAN_PAGE_SIZE:(number + 1) * WHOCAN_PAGE_SIZE]),
+                              colour=discord.Colour.dark_blue())
+            e.set_footer(text=f"Page {number + 1}/{pages}, {len(members)} members")
+            return e
+
+        await util.EmbedPaginator(self.bot, ctx, get_page, pages, user=ctx.author).start()
+
 def setup(bot: Zeta):
     bot.add_cog(Moderation(bot))
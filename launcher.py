@@ -1,5 +1,7 @@
 import os
 import sys
+import json
+import util
 import socket
 import asyncpg
 import asyncio
@@ -22,7 +24,19 @@ async def db_init(Url):
         'server_members': "CREATE TABLE server_members (guildid bigint, memberid bigint, level int, exp bigint, boost int, birthday date, PRIMARY KEY (guildid, memberid), FOREIGN KEY (guildid) REFERENCES guilds(id) ON DELETE CASCADE)",
         'selfrole_lookup': "CREATE TABLE selfrole_lookup (guildid bigint, messageid bigint PRIMARY KEY, channelid bigint, FOREIGN KEY (guildid) REFERENCES guilds(id) ON DELETE CASCADE)",
         'selfrole': "CREATE TABLE selfrole (messageid bigint, emoji varchar(100), roleid bigint, FOREIGN KEY (messageid) REFERENCES selfrole_lookup(messageid) ON DELETE CASCADE)",
-        'infractions': "CREATE TABLE infractions(id SERIAL PRIMARY KEY, guildid bigint, memberid bigint, time timestamp, reason text, FOREIGN KEY (guildid) REFERENCES guilds(id) ON DELETE CASCADE)"
+        'infractions': "CREATE TABLE infractions(id SERIAL PRIMARY KEY, guildid bigint, memberid bigint, time timestamp, reason text, FOREIGN KEY (guildid) REFERENCES guilds(id) ON DELETE CASCADE)",
+        'lockdowns': "CREATE TABLE lockdowns (guildid bigint PRIMARY KEY, permissions bigint, time timestamp, FOREIGN KEY (guildid) REFERENCES guilds(id) ON DELETE CASCADE)",
+        'birthday_alerts_sent': "CREATE TABLE birthday_alerts_sent (guildid bigint, memberid bigint, day date, PRIMARY KEY (guildid, memberid, day), FOREIGN KEY (guildid) REFERENCES guilds(id) ON DELETE CASCADE)",
+        'lockdown_overwrites': "CREATE TABLE lockdown_overwrites (guildid bigint, channelid bigint, allow bigint, deny bigint, PRIMARY KEY (guildid, channelid), FOREIGN KEY (guildid) REFERENCES lockdowns(guildid) ON DELETE CASCADE)"
+    }
+    # Indexes and columns added after the tables above were first created, safe to run on an existing database
+    migrations = {
+        'server_members_leaderboard': "CREATE INDEX IF NOT EXISTS server_members_leaderboard ON server_members (guildid, exp DESC, memberid)",
+        'mutes_mutedtill': "CREATE INDEX IF NOT EXISTS mutes_mutedtill ON mutes (mutedtill)",
+        'guilds_muterole': "ALTER TABLE guilds ADD COLUMN IF NOT EXISTS muterole bigint",
+        'guilds_timezone': "ALTER TABLE guilds ADD COLUMN IF NOT EXISTS timezone varchar(64)",
+        'infractions_member': "CREATE INDEX IF NOT EXISTS infractions_member ON infractions (guildid, memberid, time)",
+        'server_members_birthday': "CREATE INDEX IF NOT EXISTS server_members_birthday ON server_members ((date_part('month', birthday)), (date_part('day', birthday))) WHERE birthday IS NOT NULL",
     }
     count = 0
     for key, value in queries.items():
@@ -35,6 +49,10 @@ async def db_init(Url):
         print(f"{key} OK")
         count += 1
 
+    for key, value in migrations.items():
+        await conn.execute(value)
+        print(f"{key} OK")
+
     if count == len(queries):
         print("Db initialized successfully")
     else:
@@ -48,6 +66,33 @@ if sys.argv[1] == 'db':
     if sys.argv[2] == 'init':
         asyncio.get_event_loop().run_until_complete(db_init(url))
 
+async def levels_transfer(Url, action, guildid, path):
+    """
+    Imports/exports the levels of a guild from/to a CSV file, meant for when the bot isn't running, a running bot's
+    cache doesn't see the import, use the xpimport command instead then
+    """
+    pool = await asyncpg.create_pool(Url, max_size=2)
+    db = util.DB(pool)
+    try:
+        if action == 'export':
+            await db.export_members(guildid, path)
+            print(f"Exported levels of {guildid} to {path}")
+        elif action == 'import':
+            with open(path, encoding='utf-8') as f:
+                members = util.read_member_csv(f.read())
+            guild = await db.fetch_guild(guildid)
+            curve = util.LevelCurve.from_prefs(json.loads(guild['preferences']) if guild and guild['preferences'] else None)
+            await db.import_members(guildid, [(memberid, curve.level_for(exp), exp, boost) for memberid, exp, boost in members])
+            print(f"Imported levels of {len(members)} members into {guildid}")
+    finally:
+        await pool.close()
+
+if sys.argv[1] == 'levels':
+    # python launcher.py levels <import|export> <guild id> <csv file>
+    if len(sys.argv) < 5:
+        raise ValueError("Usage: launcher.py levels <import|export> <guild id> <csv file>")
+    asyncio.get_event_loop().run_until_complete(levels_transfer(os.environ['DATABASE_URL'], sys.argv[2], int(sys.argv[3]), sys.argv[4]))
+
 if sys.argv[1] == 'bot':
     if sys.argv[2] in ['start', 'kickstart']:
         bot = Zeta(token=os.environ['BOT_TOKEN'])
@@ -17,6 +17,8 @@ class Zeta(commands.AutoShardedBot):
         self.pool: asyncpg.pool.Pool = self.loop.run_until_complete(asyncpg.create_pool(os.environ['DATABASE_URL'], max_size=20))
         print(f"Connection to database made at {datetime.datetime.utcnow()}")
         self.db: util.DB = util.DB(self.pool)
+        # Background loops share this so they never take more than 6 of the 20 pool connections
+        self.scheduler: util.BackgroundScheduler = util.BackgroundScheduler(max_connections=6)
         self.cs = aiohttp.ClientSession()
         self.prefixes = {}
         self.guild_prefs = {}
@@ -25,7 +27,7 @@ class Zeta(commands.AutoShardedBot):
         self.loop.create_task(self.load_prefixes())
         self.Color = util.Color
         self.Colour = self.Color
-        self.plugins = ['levelling', 'birthdays']
+        self.plugins = ['levelling', 'birthdays', 'antispam']
         self.initinit = False
         self.token = kwargs.get('token')
         self.load_exts()
@@ -75,6 +77,7 @@ class Zeta(commands.AutoShardedBot):
             'commanderrorhandler',
             'levelsystem',
             'moderation',
+            'antispam',
             'birthdaysystem',
             'reactionroles',
             'utility',
@@ -1,3 +1,14 @@
 from .db import DB
 from .color import Color
+from .levelcache import LevelCache, MemberRecord
+from .leaderboard import Leaderboard
+from .levelcurve import LevelCurve
+from .journal import XPJournal
+from .scheduler import BackgroundScheduler
+from .paginator import EmbedPaginator
+from .memberio import read_member_csv
+from .timerheap import TimerHeap
+from .throttle import Throttle
+from .ratewindow import SlidingWindow
+from .birthdaycalendar import BirthdayCalendar
 from . import pokemon
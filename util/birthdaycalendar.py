@@ -0,0 +1,83 @@
+import calendar
+import datetime
+from bisect import bisect_left, insort
+
+# Keys are (month * 32 + day) << 64 | member id, so one sorted list of ints orders members by day of the year
+_DAY_SHIFT = 64
+_MEMBER_MASK = (1 << _DAY_SHIFT) - 1
+
+
+def _day_of(date: datetime.date) -> int:
+    return date.month * 32 + date.day
+
+
+class BirthdayCalendar:
+    """
+    Birthdays of every guild's members by day of the year, so the next birthdays of a guild can be found with a binary
+    search instead of a query.
+
+    Years are left out of the ordering, a birthday on the 29th of February sits between the 28th and the 1st of March
+    like it would in a leap year. In other years it is celebrated on the 1st of March, which only changes the order
+    when looking from the 1st of March itself, see upcoming.
+    """
+    def __init__(self):
+        # guild_id -> sorted list of keys
+        self._keys = {}
+        # guild_id -> {member_id: birthday}
+        self._birthdays = {}
+
+    def load(self, entries) -> None:
+        """
+        Fills the calendar in one go, faster than calling set for every member
+
+        Args:
+            entries: iterable of (guild_id, member_id, birthday) tuples
+        """
+        for guild_id, member_id, birthday in entries:
+            self._birthdays.setdefault(guild_id, {})[member_id] = birthday
+            self._keys.setdefault(guild_id, []).append(_day_of(birthday) << _DAY_SHIFT | member_id)
+        for keys in self._keys.values():
+            keys.sort()
+
+    def birthday(self, guild_id: int, member_id: int):
+        """Returns a member's birthday, None if they haven't set it"""
+        return self._birthdays.get(guild_id, {}).get(member_id)
+
+    def set(self, guild_id: int, member_id: int, birthday) -> None:
+        """Sets (or with None, removes) a member's birthday"""
+        self.remove(guild_id, member_id)
+        if birthday is None:
+            return
+        self._birthdays.setdefault(guild_id, {})[member_id] = birthday
+        insort(self._keys.setdefault(guild_id, []), _day_of(birthday) << _DAY_SHIFT | member_id)
+
+    def remove(self, guild_id: int, member_id: int) -> None:
+        """Forgets a member's birthday, silently ignored if it isn't known"""
+        old = self._birthdays.get(guild_id, {}).pop(member_id, None)
+        if old is None:
+            return
+        keys = self._keys[guild_id]
+        del keys[bisect_left(keys, _day_of(old) << _DAY_SHIFT | member_id)]
+        if not keys:
+            del self._keys[guild_id]
+            del self._birthdays[guild_id]
+
+    def drop_guild(self, guild_id: int) -> None:
+        self._keys.pop(guild_id, None)
+        self._birthdays.pop(guild_id, None)
+
+    def upcoming(self, guild_id: int, since: datetime.date):
+        """
+        Yields (member_id, birthday) of a guild's members by how soon their birthday comes, starting with the ones on
+        `since` and going around the year once
+        """
+        keys = self._keys.get(guild_id, [])
+        birthdays = self._birthdays.get(guild_id, {})
+        first_day = _day_of(since)
+        # The 29th of February is the 1st of March in years that don't have it, so those birthdays are on `since` too
+        if (since.month, since.day) == (3, 1) and not calendar.isleap(since.year):
+            first_day = _day_of(datetime.date(2000, 2, 29))
+        start = bisect_left(keys, first_day << _DAY_SHIFT)
+        for i in range(len(keys)):
+            member_id = keys[(start + i) % len(keys)] & _MEMBER_MASK
+            yield member_id, birthdays[member_id]
@@ -50,6 +50,29 @@ class DB:
         """
         return await self.pool.fetchrow(f"SELECT * FROM server_members WHERE memberid = $1 AND guildid = $2", memberid, guildid)
 
+    async def fetch_or_make_member(self, guildid, memberid):
+        """
+        Fetches a member from database, creating their row with default values first if they don't have one, in a
+        single round trip
+        Args:
+            guildid: the id of the guild from whence to fetch the member
+            memberid: the id of the member to fetch
+
+        Returns:
+            dict like object containing db member information
+        """
+        query = "WITH inserted AS (" \
+                "INSERT INTO server_members (guildid, memberid, level, exp, boost, birthday) " \
+                "VALUES ($1, $2, 0, 0, 1, NULL) ON CONFLICT (guildid, memberid) DO NOTHING RETURNING *" \
+                ") " \
+                "SELECT * FROM inserted " \
+                "UNION ALL SELECT * FROM server_members WHERE guildid = $1 AND memberid = $2"
+        data = await self.pool.fetchrow(query, guildid, memberid)
+        if data is None:
+            # The conflicting row was committed by another connection after this statement's snapshot was taken
+            data = await self.fetch_member(guildid, memberid)
+        return data
+
     async def fetch_guild(self, guildid):
         """
         Fetches a guild from db and returns a dict like object containing the information
@@ -76,6 +99,190 @@ class DB:
             query = "INSERT INTO server_members (guildid, memberid, level, exp, boost, birthday) VALUES ($1, $2, $3, $4, $5, $6)"
             await conn.execute(query, guildid, memberid, 0, 0, 1, None)
 
+    async def update_members(self, records):
+        """
+        Writes level system values for many members back to the server_members table in a single transaction, the rows
+        are COPY'd into a temporary table and applied with one UPDATE ... FROM instead of one round trip per member
+        Args:
+            records: list of (guildid, memberid, level, exp, boost) tuples
+
+        Returns:
+            None
+        """
+        if not records:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("CREATE TEMPORARY TABLE member_flush (guildid bigint, memberid bigint, level int, "
+                                   "exp bigint, boost int) ON COMMIT DROP")
+                await conn.copy_records_to_table('member_flush', records=records)
+                await conn.execute("UPDATE server_members "
+                                   "SET level = member_flush.level, exp = member_flush.exp, boost = member_flush.boost "
+                                   "FROM member_flush "
+                                   "WHERE server_members.guildid = member_flush.guildid "
+                                   "AND server_members.memberid = member_flush.memberid")
+
+    async def apply_member_changes(self, records):
+        """
+        Adds exp to and optionally sets the boost of many members in a single transaction, the same way update_members
+        does it, used to replay changes that never made it into the database
+        Args:
+            records: list of (guildid, memberid, exp to add, boost to set or None) tuples
+
+        Returns:
+            None
+        """
+        if not records:
+            return
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("CREATE TEMPORARY TABLE member_changes (guildid bigint, memberid bigint, exp bigint, "
+                                   "boost int) ON COMMIT DROP")
+                await conn.copy_records_to_table('member_changes', records=records)
+                await conn.execute("UPDATE server_members "
+                                   "SET exp = server_members.exp + member_changes.exp, "
+                                   "boost = COALESCE(member_changes.boost, server_members.boost) "
+                                   "FROM member_changes "
+                                   "WHERE server_members.guildid = member_changes.guildid "
+                                   "AND server_members.memberid = member_changes.memberid")
+
+    async def fetch_leaderboard_page(self, guildid, limit, after=None):
+        """
+        Fetches members of a guild ordered by exp (highest first, ties by member id) using keyset pagination, so any
+        page costs an index range scan no matter how deep it is
+        Args:
+            guildid: id of the relevant guild
+            limit: the number of members to fetch
+            after: (exp, memberid) of the last member of the previous page, None for the first page
+
+        Returns:
+            list of records with memberid and exp
+        """
+        if after is None:
+            return await self.pool.fetch("SELECT memberid, exp FROM server_members WHERE guildid = $1 "
+                                         "ORDER BY exp DESC, memberid LIMIT $2", guildid, limit)
+        # exp <= $2 is implied by the condition after it, but spelled out it lets the index seek straight to the
+        # previous page's last member instead of scanning the guild's entries from the top
+        return await self.pool.fetch("SELECT memberid, exp FROM server_members WHERE guildid = $1 AND exp <= $2 "
+                                     "AND (exp < $2 OR (exp = $2 AND memberid > $3)) "
+                                     "ORDER BY exp DESC, memberid LIMIT $4", guildid, after[0], after[1], limit)
+
+    async def import_members(self, guildid, records):
+        """
+        Bulk inserts members of a guild with COPY, members that already exist get their level/exp/boost overwritten
+        Args:
+            guildid: id of the relevant guild
+            records: list of (memberid, level, exp, boost) tuples
+
+        Returns:
+            None
+        """
+        await self.make_guild_entry(guildid)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("CREATE TEMPORARY TABLE member_import (memberid bigint, level int, exp bigint, "
+                                   "boost int) ON COMMIT DROP")
+                await conn.copy_records_to_table('member_import', records=records)
+                await conn.execute("INSERT INTO server_members (guildid, memberid, level, exp, boost) "
+                                   "SELECT $1, memberid, level, exp, boost FROM member_import "
+                                   "ON CONFLICT (guildid, memberid) DO UPDATE "
+                                   "SET level = EXCLUDED.level, exp = EXCLUDED.exp, boost = EXCLUDED.boost", guildid)
+
+    async def export_members(self, guildid, output):
+        """
+        Streams the members of a guild out as CSV (memberid,exp,level,boost with a header) with COPY
+        Args:
+            guildid: id of the relevant guild
+            output: a path or a file like object opened for binary writing
+
+        Returns:
+            None
+        """
+        async with self.pool.acquire() as conn:
+            await conn.copy_from_query("SELECT memberid, exp, level, boost FROM server_members WHERE guildid = $1 "
+                                       "ORDER BY exp DESC, memberid", guildid,
+                                       output=output, format='csv', header=True)
+
+    async def relevel_guild(self, guildid, thresholds, level_for):
+        """
+        Recomputes the level of every member of a guild from their exp with a single UPDATE, members with more exp than
+        the last threshold (rare) get theirs from level_for
+        Args:
+            guildid: id of the relevant guild
+            thresholds: sorted sequence of the exp needed for every level, thresholds[0] being the exp for level 1
+            level_for: function giving the level of an amount of exp
+
+        Returns:
+            None
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("UPDATE server_members SET level = width_bucket(exp, $1::bigint[]) WHERE guildid = $2",
+                                   list(thresholds), guildid)
+                beyond = await conn.fetch("SELECT memberid, exp FROM server_members WHERE guildid = $1 AND exp >= $2",
+                                          guildid, thresholds[-1])
+                await conn.executemany("UPDATE server_members SET level = $1 WHERE guildid = $2 AND memberid = $3",
+                                       [(level_for(entry.get('exp')), guildid, entry.get('memberid')) for entry in beyond])
+
+    async def fetch_alert_guilds(self, guildid=None):
+        """
+        Fetches the birthday alert settings of every guild that has alerts set up
+        Args:
+            guildid: only fetch this guild, None for all of them
+
+        Returns:
+            list of records with id, bdayalert, bdayalerttime and timezone
+        """
+        return await self.pool.fetch("SELECT id, bdayalert, bdayalerttime, timezone FROM guilds "
+                                     "WHERE bdayalert IS NOT NULL AND bdayalerttime IS NOT NULL "
+                                     "AND ($1::bigint IS NULL OR id = $1)", guildid)
+
+    async def fetch_birthdays(self, slots):
+        """
+        Fetches everyone having their birthday in some guilds on some days with a single query, the members are found
+        through the server_members_birthday index. Alerts already marked sent with mark_birthdays_sent are left out.
+        Args:
+            slots: list of (guildid, day) tuples, only month and day of the day count
+
+        Returns:
+            list of records with guildid, day and memberid
+        """
+        return await self.pool.fetch(
+            "SELECT s.guildid, s.day, m.memberid "
+            "FROM unnest($1::bigint[], $2::date[]) AS s (guildid, day) "
+            "JOIN server_members m ON m.guildid = s.guildid "
+            "AND date_part('month', m.birthday) = date_part('month', s.day) "
+            "AND date_part('day', m.birthday) = date_part('day', s.day) "
+            "WHERE m.birthday IS NOT NULL "
+            "AND NOT EXISTS (SELECT 1 FROM birthday_alerts_sent a "
+            "WHERE a.guildid = s.guildid AND a.memberid = m.memberid AND a.day = s.day)",
+            [slot[0] for slot in slots], [slot[1] for slot in slots])
+
+    async def mark_birthdays_sent(self, records):
+        """
+        Marks birthday alerts as sent, so they're never sent twice even across restarts
+        Args:
+            records: list of (guildid, memberid, day) tuples
+
+        Returns:
+            list of records with guildid, memberid and day of the ones that weren't already marked
+        """
+        return await self.pool.fetch("INSERT INTO birthday_alerts_sent (guildid, memberid, day) "
+                                     "SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::date[]) "
+                                     "ON CONFLICT DO NOTHING RETURNING guildid, memberid, day",
+                                     [r[0] for r in records], [r[1] for r in records], [r[2] for r in records])
+
+    async def forget_birthdays_sent(self, before):
+        """
+        Drops the sent markers of alerts from before a day
+        Args:
+            before: the day
+
+        Returns:
+            None
+        """
+        await self.pool.execute("DELETE FROM birthday_alerts_sent WHERE day < $1", before)
+
     async def hakai_member(self, guildid, memberid):
         """
         Removes a member from the server_members table
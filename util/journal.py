@@ -0,0 +1,132 @@
+import os
+import mmap
+import struct
+
+# op, guild id, member id, value
+RECORD = struct.Struct('<Bqqq')
+_VALUES = struct.Struct('<qqq')
+
+OP_EXP = 1
+OP_BOOST = 2
+OP_RESET = 3
+
+
+class XPJournal:
+    """
+    Append-only local log of level system changes that haven't been written to the database yet, so they can be
+    replayed if the bot dies between two flushes.
+
+    The file is memory mapped, which makes an append a copy into memory that the OS writes back to disk by itself,
+    even when the process crashes. Records are fixed size (see RECORD), the file is preallocated with zeroes and a
+    record with op 0 marks the end of the log.
+    """
+    def __init__(self, path: str, initial_size: int = 1 << 20):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = max(os.fstat(self._fd).st_size, initial_size)
+        size -= size % RECORD.size
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+        self._end = 0
+        while self._end + RECORD.size <= size and self._map[self._end] != 0:
+            self._end += RECORD.size
+        # Ids of the guilds that have records in the log
+        self._guild_ids = self._scan_guild_ids()
+
+    def __len__(self):
+        return self._end // RECORD.size
+
+    def _scan_guild_ids(self) -> set:
+        return {guild_id for _, guild_id, _, _ in RECORD.iter_unpack(self._map[:self._end])}
+
+    def guild_ids(self) -> set:
+        """Returns the ids of every guild that has something logged"""
+        return set(self._guild_ids)
+
+    def _append(self, op: int, guild_id: int, member_id: int, value: int) -> None:
+        if self._end + RECORD.size > len(self._map):
+            self._grow()
+        # The op goes in last, a record is only part of the log once its op isn't 0
+        _VALUES.pack_into(self._map, self._end + 1, guild_id, member_id, value)
+        self._map[self._end] = op
+        self._end += RECORD.size
+        self._guild_ids.add(guild_id)
+
+    def _grow(self) -> None:
+        size = len(self._map) * 2
+        self._map.close()
+        os.ftruncate(self._fd, size)
+        self._map = mmap.mmap(self._fd, size)
+
+    def exp(self, guild_id: int, member_id: int, amount: int) -> None:
+        """Logs exp given to a member"""
+        self._append(OP_EXP, guild_id, member_id, amount)
+
+    def boost(self, guild_id: int, member_id: int, boost: int) -> None:
+        """Logs a member's boost multiplier being set"""
+        self._append(OP_BOOST, guild_id, member_id, boost)
+
+    def reset(self, guild_id: int, member_id: int) -> None:
+        """Logs a member being removed from the database, making everything logged for them before it void"""
+        self._append(OP_RESET, guild_id, member_id, 0)
+
+    def checkpoint(self) -> int:
+        """
+        Returns the current end of the log, to be passed to truncate once everything logged so far is in the database
+        """
+        return self._end
+
+    def truncate(self, checkpoint: int) -> None:
+        """
+        Drops everything logged before a checkpoint, anything logged after it is kept
+        """
+        remaining = self._end - checkpoint
+        if remaining:
+            self._map.move(0, checkpoint, remaining)
+        self._map[remaining:self._end] = bytes(self._end - remaining)
+        self._end = remaining
+        self._guild_ids = self._scan_guild_ids()
+
+    def compact(self, guild_ids, checkpoint: int) -> None:
+        """
+        Drops what was logged for some guilds before a checkpoint, everything else is kept in order
+
+        Note that this moves records around, so checkpoints taken before it are no good afterwards
+        """
+        guild_ids = set(guild_ids)
+        if not guild_ids & self._guild_ids:
+            return
+        log = self._map[:self._end]
+        kept = bytearray()
+        for offset, (_, guild_id, _, _) in zip(range(0, self._end, RECORD.size), RECORD.iter_unpack(log)):
+            if offset >= checkpoint or guild_id not in guild_ids:
+                kept += log[offset:offset + RECORD.size]
+        self._map[:len(kept)] = kept
+        self._map[len(kept):self._end] = bytes(self._end - len(kept))
+        self._end = len(kept)
+        self._guild_ids = self._scan_guild_ids()
+
+    def pending(self) -> dict:
+        """
+        Folds the log into the changes it represents
+
+        Returns: dict of (guild_id, member_id) -> [exp to add, boost to set or None]
+        """
+        changes = {}
+        for op, guild_id, member_id, value in RECORD.iter_unpack(self._map[:self._end]):
+            key = (guild_id, member_id)
+            if op == OP_RESET:
+                changes.pop(key, None)
+                continue
+            change = changes.setdefault(key, [0, None])
+            if op == OP_EXP:
+                change[0] += value
+            elif op == OP_BOOST:
+                change[1] = value
+        return changes
+
+    def close(self) -> None:
+        self._map.flush()
+        self._map.close()
+        os.close(self._fd)
@@ -0,0 +1,75 @@
+from bisect import bisect_left
+
+
+class Leaderboard:
+    """
+    Exp ranking of a single guild's members, kept sorted in memory so leaderboard and rank lookups don't need the
+    database.
+
+    Members are ordered by exp descending with ties broken by member id, internally that's a sorted list of
+    (-exp, member_id) keys next to a member_id -> exp dict so a member's key can be found with a binary search.
+    """
+    def __init__(self, entries=()):
+        """
+        Args:
+            entries: iterable of (member_id, exp) pairs to start with, in any order
+        """
+        self._exp = dict(entries)
+        self._keys = sorted((-exp, member_id) for member_id, exp in self._exp.items())
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, member_id):
+        return member_id in self._exp
+
+    def update(self, member_id: int, exp: int):
+        """
+        Inserts a member or moves them to the position their new exp puts them at
+
+        Returns: (first, last) 0 based positions whose entry changed, last being None if everything from first onwards
+                 shifted, None if nothing changed
+        """
+        old = self._exp.get(member_id)
+        if old == exp:
+            return None
+        old_position = None
+        if old is not None:
+            old_position = bisect_left(self._keys, (-old, member_id))
+            del self._keys[old_position]
+        self._exp[member_id] = exp
+        key = (-exp, member_id)
+        position = bisect_left(self._keys, key)
+        self._keys.insert(position, key)
+        if old_position is None:
+            return position, None
+        return min(position, old_position), max(position, old_position)
+
+    def remove(self, member_id: int):
+        """
+        Takes a member out of the ranking, silently ignored if they aren't in it
+
+        Returns: (first, None) like update does, None if the member wasn't ranked
+        """
+        old = self._exp.pop(member_id, None)
+        if old is None:
+            return None
+        position = bisect_left(self._keys, (-old, member_id))
+        del self._keys[position]
+        return position, None
+
+    def rank(self, member_id: int):
+        """
+        Returns the 1 based rank of a member, None if they aren't ranked
+        """
+        exp = self._exp.get(member_id)
+        if exp is None:
+            return None
+        return bisect_left(self._keys, (-exp, member_id)) + 1
+
+    def top(self, limit: int, offset: int = 0) -> list:
+        """
+        Returns: list of (rank, member_id, exp) tuples for `limit` members starting after the first `offset` ones
+        """
+        return [(offset + i + 1, member_id, -neg_exp)
+                for i, (neg_exp, member_id) in enumerate(self._keys[offset:offset + limit])]
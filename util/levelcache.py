@@ -0,0 +1,270 @@
+import time
+from array import array
+from typing import NamedTuple
+
+
+class MemberRecord(NamedTuple):
+    """Snapshot of a cached member, changes go through LevelCache methods"""
+    id: int
+    level: int
+    exp: int
+    boost: int
+
+
+class _GuildColumns:
+    """
+    The cached members of one guild stored as parallel arrays, a member's values all live at the same position which
+    is looked up in `index`. Removing a member moves the last member into its position so the arrays stay dense.
+    """
+    __slots__ = ('index', 'ids', 'levels', 'exp', 'boosts', 'seen', 'dirty')
+
+    def __init__(self):
+        self.index = {}
+        self.ids = array('q')
+        self.levels = array('i')
+        self.exp = array('q')
+        self.boosts = array('i')
+        # Monotonic clock, whole seconds
+        self.seen = array('I')
+        self.dirty = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def record(self, pos: int) -> MemberRecord:
+        return MemberRecord(self.ids[pos], self.levels[pos], self.exp[pos], self.boosts[pos])
+
+    def append(self, member_id: int, level: int, exp: int, boost: int, seen: int) -> int:
+        pos = self.index[member_id] = len(self.ids)
+        self.ids.append(member_id)
+        self.levels.append(level)
+        self.exp.append(exp)
+        self.boosts.append(boost)
+        self.seen.append(seen)
+        return pos
+
+    def remove(self, member_id: int) -> None:
+        pos = self.index.pop(member_id)
+        last = len(self.ids) - 1
+        if pos != last:
+            moved = self.ids[last]
+            self.ids[pos] = moved
+            self.levels[pos] = self.levels[last]
+            self.exp[pos] = self.exp[last]
+            self.boosts[pos] = self.boosts[last]
+            self.seen[pos] = self.seen[last]
+            self.index[moved] = pos
+        for column in (self.ids, self.levels, self.exp, self.boosts, self.seen):
+            column.pop()
+        self.dirty.discard(member_id)
+
+
+class LevelCache:
+    """
+    Write-behind cache for the level system's member records.
+
+    Records stay warm between database flushes, every change marks its record dirty and only the dirty ones get written
+    back. Records that haven't been touched in a while are evicted, and if the cache still holds more than
+    `max_members` records the least recently used ones go too. Dirty records are never evicted before they're flushed.
+
+    Each guild's members are kept in compact parallel arrays rather than a dict per member, reads hand out MemberRecord
+    snapshots and writes go through put/update/add_exp.
+    """
+    def __init__(self, max_members: int, idle_seconds: int):
+        self.max_members = max_members
+        self.idle_seconds = idle_seconds
+        self._guilds = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, key):
+        guild_id, member_id = key
+        columns = self._guilds.get(guild_id)
+        return columns is not None and member_id in columns.index
+
+    def _position(self, guild_id: int, member_id: int):
+        columns = self._guilds.get(guild_id)
+        if columns is None:
+            return None, None
+        return columns, columns.index.get(member_id)
+
+    def get(self, guild_id: int, member_id: int):
+        """
+        Returns the cached MemberRecord of a member and marks it as recently used, None if it isn't cached
+        """
+        columns, pos = self._position(guild_id, member_id)
+        if pos is None:
+            return None
+        columns.seen[pos] = int(time.monotonic())
+        return columns.record(pos)
+
+    def put(self, guild_id: int, member_id: int, level: int, exp: int, boost: int, dirty: bool = False) -> MemberRecord:
+        """
+        Puts a member's record into the cache, replacing any existing one
+
+        `dirty` should only be set if the values aren't in the database yet.
+        """
+        columns, pos = self._position(guild_id, member_id)
+        if columns is None:
+            columns = self._guilds[guild_id] = _GuildColumns()
+        if pos is None:
+            pos = columns.append(member_id, level, exp, boost, int(time.monotonic()))
+            self._size += 1
+        else:
+            columns.levels[pos] = level
+            columns.exp[pos] = exp
+            columns.boosts[pos] = boost
+            columns.seen[pos] = int(time.monotonic())
+        if dirty:
+            columns.dirty.add(member_id)
+        return columns.record(pos)
+
+    def update(self, guild_id: int, member_id: int, level: int = None, exp: int = None,
+               boost: int = None) -> MemberRecord:
+        """
+        Changes level/exp/boost of a cached member and marks the record dirty
+
+        Raises KeyError if the member isn't cached.
+        """
+        columns, pos = self._position(guild_id, member_id)
+        if pos is None:
+            raise KeyError((guild_id, member_id))
+        if level is not None:
+            columns.levels[pos] = level
+        if exp is not None:
+            columns.exp[pos] = exp
+        if boost is not None:
+            columns.boosts[pos] = boost
+        columns.seen[pos] = int(time.monotonic())
+        columns.dirty.add(member_id)
+        return columns.record(pos)
+
+    def add_exp(self, guild_id: int, member_id: int, amount: int) -> MemberRecord:
+        """
+        Adds exp to a cached member and marks the record dirty
+
+        Raises KeyError if the member isn't cached.
+        """
+        columns, pos = self._position(guild_id, member_id)
+        if pos is None:
+            raise KeyError((guild_id, member_id))
+        return self.update(guild_id, member_id, exp=columns.exp[pos] + amount)
+
+    def remove(self, guild_id: int, member_id: int) -> None:
+        """
+        Forgets a member without writing it back, silently ignored if not cached
+        """
+        columns, pos = self._position(guild_id, member_id)
+        if pos is not None:
+            columns.remove(member_id)
+            self._size -= 1
+
+    def drop_guild(self, guild_id: int) -> None:
+        """
+        Forgets every member of a guild without writing them back
+        """
+        columns = self._guilds.pop(guild_id, None)
+        if columns is not None:
+            self._size -= len(columns)
+
+    def has_guild(self, guild_id: int) -> bool:
+        """
+        Tells whether any member of a guild is cached
+        """
+        return guild_id in self._guilds
+
+    def is_dirty(self, guild_id: int, member_id: int) -> bool:
+        """
+        Tells whether a member has changes that haven't been written back yet
+        """
+        columns = self._guilds.get(guild_id)
+        return columns is not None and member_id in columns.dirty
+
+    def guild_ids(self) -> list:
+        """
+        Returns the ids of every guild with cached members
+        """
+        return list(self._guilds)
+
+    def members(self, guild_id: int) -> list:
+        """
+        Returns the MemberRecords of every cached member of a guild
+        """
+        columns = self._guilds.get(guild_id)
+        if columns is None:
+            return []
+        return [columns.record(pos) for pos in range(len(columns))]
+
+    def set_levels(self, guild_id: int, levels_for) -> None:
+        """
+        Recomputes the level of every cached member of a guild in one go, without marking them dirty
+
+        Args:
+            guild_id: the guild whose members should be recomputed
+            levels_for: callable taking the guild's exp column and returning an array('i') of levels for it
+        """
+        columns = self._guilds.get(guild_id)
+        if columns is not None:
+            columns.levels = levels_for(columns.exp)
+
+    def take_dirty(self, guild_ids=None) -> list:
+        """
+        Removes records from the dirty set and returns them
+
+        Args:
+            guild_ids: only take the dirty records of these guilds, defaults to every guild
+
+        Returns: list of (guildid, memberid, level, exp, boost) tuples, as accepted by DB.update_members
+        """
+        if guild_ids is None:
+            guild_ids = list(self._guilds)
+        records = []
+        for guild_id in guild_ids:
+            columns = self._guilds.get(guild_id)
+            if columns is None:
+                continue
+            for member_id in columns.dirty:
+                pos = columns.index[member_id]
+                records.append((guild_id, member_id, columns.levels[pos], columns.exp[pos], columns.boosts[pos]))
+            columns.dirty = set()
+        return records
+
+    def mark_dirty(self, records) -> None:
+        """
+        Marks records dirty again, used when writing back what take_dirty returned failed
+        """
+        for guild_id, member_id, *_ in records:
+            if (guild_id, member_id) in self:
+                self._guilds[guild_id].dirty.add(member_id)
+
+    def evict(self) -> int:
+        """
+        Evicts clean records that have been idle for longer than `idle_seconds`, then the least recently used clean
+        records until the cache is within `max_members`
+
+        Returns: the number of records evicted
+        """
+        deadline = int(time.monotonic()) - self.idle_seconds
+        evicted = 0
+        for guild_id, columns in list(self._guilds.items()):
+            idle = [columns.ids[pos] for pos, seen in enumerate(columns.seen) if seen < deadline]
+            for member_id in idle:
+                if member_id not in columns.dirty:
+                    columns.remove(member_id)
+                    evicted += 1
+            if not len(columns):
+                del self._guilds[guild_id]
+        self._size -= evicted
+
+        excess = self._size - self.max_members
+        if excess > 0:
+            clean = [(seen, guild_id, columns.ids[pos])
+                     for guild_id, columns in self._guilds.items()
+                     for pos, seen in enumerate(columns.seen) if columns.ids[pos] not in columns.dirty]
+            clean.sort()
+            for _, guild_id, member_id in clean[:excess]:
+                self.remove(guild_id, member_id)
+                evicted += 1
+        return evicted
@@ -0,0 +1,120 @@
+from math import isqrt
+from array import array
+from bisect import bisect_right
+
+# Levels past this aren't in the table, curves that get there work the level out with their closed form instead
+MAX_LEVEL = 10000
+
+# Exp is stored as bigint
+MAX_EXP = 2 ** 63 - 1
+
+# Levels are stored as int, only the linear curve with a small factor can get past it
+MAX_STORED_LEVEL = 2 ** 31 - 1
+
+
+def _quadratic(factor: int, level: int) -> int:
+    return factor * level * (level - 1)
+
+
+def _linear(factor: int, level: int) -> int:
+    return factor * (level - 1)
+
+
+def _quadratic_level(factor: int, exp: int) -> int:
+    # Largest level with level * (level - 1) <= exp // factor, in integers so it's exact for any bigint
+    return (isqrt(4 * (exp // factor) + 1) + 1) // 2
+
+
+def _linear_level(factor: int, exp: int) -> int:
+    return exp // factor + 1
+
+
+def _exponential(factor: int, level: int) -> int:
+    # Every level needs 5% more exp than the one before it, the first one needs `factor`
+    return round(factor * (1.05 ** (level - 1) - 1) / 0.05)
+
+
+# name -> (function giving the exp needed to reach a level, default factor, function giving the level of an amount of
+# exp past the table or None if the table already reaches MAX_EXP)
+CURVES = {
+    'quadratic': (_quadratic, 25, _quadratic_level),
+    'linear': (_linear, 100, _linear_level),
+    'exponential': (_exponential, 100, None),
+}
+
+DEFAULT_CURVE = 'quadratic'
+
+_tables = {}
+_curves = {}
+
+
+class LevelCurve:
+    """
+    Translates exp into levels with a table of the exp needed for every level, computed once per curve, a lookup is
+    then just a binary search over it. The table stops at MAX_LEVEL, exp past its last threshold goes through the
+    curve's closed form.
+
+    The default curve (quadratic, factor 25) gives the same levels as floor((25 + sqrt(625 + 100 * exp)) / 50).
+    """
+    __slots__ = ('name', 'factor', 'thresholds', '_beyond')
+
+    def __init__(self, name: str = DEFAULT_CURVE, factor: int = None):
+        """
+        Args:
+            name: one of the keys of CURVES
+            factor: scales the curve, defaults to the curve's own default factor
+
+        Raises:
+            ValueError: if the curve name is unknown or the factor isn't positive
+        """
+        if name not in CURVES:
+            raise ValueError(f"Unknown level curve {name}, valid ones are {', '.join(CURVES)}")
+        function, default, beyond = CURVES[name]
+        factor = default if factor is None else int(factor)
+        if factor < 1:
+            raise ValueError("Level curve factor must be a positive number")
+        self.name = name
+        self.factor = factor
+
+        key = (name, factor)
+        if key not in _tables:
+            # thresholds[i] is the exp needed for level i + 1, so bisecting exp into it gives the level straight away
+            thresholds = array('q')
+            for level in range(1, MAX_LEVEL + 1):
+                needed = function(factor, level)
+                if needed > MAX_EXP:
+                    break
+                thresholds.append(needed)
+            _tables[key] = thresholds
+        self.thresholds = _tables[key]
+        self._beyond = beyond
+
+    @classmethod
+    def from_prefs(cls, prefs) -> 'LevelCurve':
+        """
+        Returns the curve stored in a guild's preferences dict, the default one if it doesn't have any
+        """
+        stored = (prefs or {}).get('levelcurve') or {}
+        key = (stored.get('name', DEFAULT_CURVE), stored.get('factor'))
+        if key not in _curves:
+            _curves[key] = cls(*key)
+        return _curves[key]
+
+    def to_prefs(self) -> dict:
+        """
+        Returns the curve in the format stored under the 'levelcurve' key of guild preferences
+        """
+        return {'name': self.name, 'factor': self.factor}
+
+    def level_for(self, exp: int) -> int:
+        """Returns the level a given amount of exp translates to"""
+        if self._beyond is not None and exp >= self.thresholds[-1]:
+            return min(self._beyond(self.factor, exp), MAX_STORED_LEVEL)
+        return bisect_right(self.thresholds, exp)
+
+    def levels_for(self, exps) -> array:
+        """Returns an array('i') with the level of every amount of exp in `exps`"""
+        return array('i', map(self.level_for, exps))
+
+    def __str__(self):
+        return f"{self.name} (factor {self.factor})"
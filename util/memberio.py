@@ -0,0 +1,29 @@
+import csv
+import io
+
+
+def read_member_csv(text: str) -> list:
+    """
+    Parses a levels CSV in the format exports use, `memberid,exp[,level[,boost]]`, a header row is skipped and the
+    level column is ignored since levels are recomputed from exp with the guild's curve. A member listed more than
+    once gets the values of their last row
+
+    Args:
+        text: the contents of the CSV file
+
+    Returns: list of (memberid, exp, boost) tuples with unique member ids, boost defaulting to 1
+
+    Raises:
+        ValueError: with the offending line number if a row can't be read
+    """
+    # memberid -> (exp, boost), the import's upsert can't touch the same row twice
+    members = {}
+    for line, row in enumerate(csv.reader(io.StringIO(text)), start=1):
+        if not row or (line == 1 and not row[0].strip().isdigit()):
+            continue
+        try:
+            boost = int(row[3]) if len(row) > 3 and row[3].strip() else 1
+            members[int(row[0])] = (int(row[1]), boost)
+        except (ValueError, IndexError):
+            raise ValueError(f"Couldn't read line {line} of the CSV, expected memberid,exp[,level,boost]")
+    return [(memberid, exp, boost) for memberid, (exp, boost) in members.items()]
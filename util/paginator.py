@@ -0,0 +1,61 @@
+import asyncio
+import discord
+
+PREVIOUS = '\u25c0'
+NEXT = '\u25b6'
+
+
+class EmbedPaginator:
+    """
+    Sends one page of something and lets people flip through the rest with reactions, pages are only built when
+    they're shown.
+    """
+    def __init__(self, bot, destination: discord.abc.Messageable, get_page, pages: int, user: discord.abc.User = None,
+                 timeout: float = 60):
+        """
+        Args:
+            bot: the bot, used to wait for reactions
+            destination: where the pages get sent
+            get_page: coroutine function taking a 0 based page number and returning the discord.Embed for that page
+            pages: the number of pages
+            user: the only user allowed to flip pages, anyone can if None
+            timeout: seconds without a reaction after which flipping stops
+        """
+        self.bot = bot
+        self.destination = destination
+        self.get_page = get_page
+        self.pages = pages
+        self.user = user
+        self.timeout = timeout
+
+    async def start(self, page: int = 0) -> discord.Message:
+        """
+        Sends the given page, then keeps flipping pages as reactions come in until the timeout runs out
+        """
+        message = await self.destination.send(embed=await self.get_page(page))
+        if self.pages <= 1:
+            return message
+        for button in (PREVIOUS, NEXT):
+            await message.add_reaction(button)
+
+        def check(r: discord.Reaction, u):
+            return r.message.id == message.id and str(r.emoji) in (PREVIOUS, NEXT) and not u.bot and \
+                (self.user is None or u == self.user)
+
+        while True:
+            try:
+                r, u = await self.bot.wait_for('reaction_add', check=check, timeout=self.timeout)
+            except asyncio.TimeoutError:
+                break
+            page = (page + (1 if str(r.emoji) == NEXT else -1)) % self.pages
+            await message.edit(embed=await self.get_page(page))
+            try:
+                await message.remove_reaction(r.emoji, u)
+            except discord.Forbidden:
+                pass
+
+        try:
+            await message.clear_reactions()
+        except discord.Forbidden:
+            pass
+        return message
@@ -0,0 +1,34 @@
+from array import array
+
+
+class SlidingWindow:
+    """
+    Tells whether `count` events happened within `seconds`, checked on every event in O(1).
+
+    The times of the last `count` events are kept in a fixed size ring buffer, so once the ring is full the slot about
+    to be written next holds the oldest of them. If that one is within `seconds` of the newest, all `count` are.
+    """
+    __slots__ = ('count', 'seconds', 'last', '_times', '_head')
+
+    def __init__(self, count: int, seconds: float):
+        self.count = count
+        self.seconds = seconds
+        self.last = float('-inf')
+        self._times = array('d', [float('-inf')]) * count
+        self._head = 0
+
+    def hit(self, now: float) -> bool:
+        """
+        Records an event at `now` (any monotonic clock in seconds)
+
+        Returns: True if this event makes it `count` events within `seconds`
+        """
+        self._times[self._head] = now
+        self._head = (self._head + 1) % self.count
+        self.last = now
+        return now - self._times[self._head] <= self.seconds
+
+    def clear(self) -> None:
+        """Forgets every event recorded so far"""
+        for i in range(self.count):
+            self._times[i] = float('-inf')
@@ -0,0 +1,76 @@
+import time
+import asyncio
+import datetime
+from typing import NamedTuple
+from contextlib import asynccontextmanager
+
+
+class CycleTiming(NamedTuple):
+    started_at: datetime.datetime
+    seconds: float
+
+
+def slot_of(key: int, slots: int) -> int:
+    """
+    Returns which of `slots` slots an id falls into, snowflakes are hashed first since their low bits aren't evenly
+    spread
+    """
+    return ((key * 11400714819323198485) >> 32) % slots
+
+
+class BackgroundScheduler:
+    """
+    Shared by the background loops so that together they never hold more than `max_connections` pool connections,
+    leaving the rest of the pool to commands, and so that how long their cycles take can be looked up.
+    """
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self._semaphore = asyncio.Semaphore(max_connections)
+
+        # loop name -> CycleTiming of its last completed cycle
+        self.timings = {}
+
+    @asynccontextmanager
+    async def connection_slot(self):
+        """
+        Background work has to hold one of these while it uses a pool connection
+        """
+        async with self._semaphore:
+            yield
+
+    @asynccontextmanager
+    async def cycle(self, name: str):
+        """
+        Times the cycle of a background loop, the result ends up in `timings` under `name`
+        """
+        started_at = datetime.datetime.utcnow()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = CycleTiming(started_at, time.perf_counter() - start)
+
+    async def staggered(self, get_keys, interval: float, slots: int, work) -> list:
+        """
+        Spreads work over an interval instead of doing it in one burst, the keys are split into `slots` slots by hash
+        and each slot gets its turn an equal part of the interval after the previous one.
+
+        Args:
+            get_keys: callable returning the current keys (guild ids for instance), called again for every slot so
+                      keys that showed up in the meantime aren't missed
+            interval: seconds to spread the slots over
+            slots: number of slots
+            work: coroutine function called with the list of keys of a slot, skipped for empty slots
+
+        Returns: list of whatever work returned for every non empty slot
+        """
+        start = time.monotonic()
+        results = []
+        for slot in range(slots):
+            delay = start + slot * interval / slots - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            keys = [key for key in get_keys() if slot_of(key, slots) == slot]
+            if keys:
+                results.append(await work(keys))
+        return results
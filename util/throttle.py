@@ -0,0 +1,100 @@
+import time
+import asyncio
+import discord
+
+
+class Throttle:
+    """
+    Caps how many calls run at once and optionally how many start per period, for bursts of API calls that would otherwise
+    either crawl along one at a time or run into Discord's rate limits.
+
+    Used as an async context manager around each call, or through gather for a whole batch of them, gather also
+    retries calls that still got rate limited.
+    """
+    def __init__(self, concurrency: int, rate: int = None, per: float = None, retries: int = 0, backoff: float = 1):
+        """
+        Args:
+            concurrency: most calls allowed to be in flight at once
+            rate: most calls allowed to start within `per` seconds, None to only cap concurrency and leave the rest to
+                  Discord's own rate limit buckets
+            per: length of the rate limit window in seconds
+            retries: times gather retries a call that failed with a 429
+            backoff: seconds gather waits before the first retry, doubled for every retry after it
+        """
+        self.concurrency = concurrency
+        self.rate = rate
+        self.per = per
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._lock = asyncio.Lock()
+        # Start times of the last `rate` calls, oldest first
+        self._starts = []
+
+    async def _wait_for_rate(self) -> None:
+        async with self._lock:
+            if len(self._starts) >= self.rate:
+                delay = self._starts[0] + self.per - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                del self._starts[0]
+            self._starts.append(time.monotonic())
+
+    async def __aenter__(self):
+        await self._semaphore.acquire()
+        if self.rate is None:
+            return self
+        try:
+            await self._wait_for_rate()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._semaphore.release()
+
+    async def gather(self, func, items, progress=None) -> list:
+        """
+        Calls a coroutine function on every item within the limits
+
+        Args:
+            func: coroutine function taking an item
+            items: the items
+            progress: optional coroutine function called with (done, total) after every call finishes, exceptions it
+                      raises are printed and otherwise ignored
+
+        Returns: list of what func returned for every item in order, exceptions it raised are returned in their place
+                 instead of being raised
+        """
+        items = list(items)
+        done = 0
+
+        async def call(item):
+            for attempt in range(self.retries + 1):
+                try:
+                    async with self:
+                        return await func(item)
+                except discord.HTTPException as error:
+                    if error.status != 429 or attempt == self.retries:
+                        raise
+                await asyncio.sleep(self.backoff * 2 ** attempt)
+
+        async def run(item):
+            nonlocal done
+            try:
+                result = await call(item)
+            except Exception as error:
+                result = error
+            done += 1
+            if progress is not None:
+                # Only reporting, so it failing mustn't turn the call's result into a failure
+                try:
+                    await progress(done, len(items))
+                except Exception as error:
+                    print(f"Throttle progress callback failed: {error!r}")
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        return await asyncio.gather(*[run(item) for item in items], return_exceptions=True)
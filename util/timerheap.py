@@ -0,0 +1,81 @@
+import heapq
+import itertools
+
+
+class TimerHeap:
+    """
+    Keyed deadlines kept in a min-heap, so one loop can wait on the earliest of any number of timers instead of each
+    timer parking a coroutine of its own.
+
+    Pushing and popping are O(log n). Cancelling only marks the entry dead, dead entries are skipped once they reach
+    the top, and the heap is rebuilt when they make up more than half of it. Pushing a key that's already scheduled
+    replaces its deadline.
+    """
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._dead = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def push(self, key, when, payload=None) -> None:
+        """
+        Schedules `key` at `when`, any comparable deadline works as long as all of them are of the same type
+        """
+        self.cancel(key)
+        # entry: [deadline, tie breaker, key, payload, alive]
+        entry = [when, next(self._counter), key, payload, True]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def cancel(self, key):
+        """
+        Unschedules a key
+
+        Returns: the payload the key was pushed with, None if it wasn't scheduled
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return None
+        entry[4] = False
+        self._dead += 1
+        if self._dead > len(self._heap) // 2:
+            self._heap = [e for e in self._heap if e[4]]
+            heapq.heapify(self._heap)
+            self._dead = 0
+        return entry[3]
+
+    def when(self, key):
+        """Returns the deadline of a key, None if it isn't scheduled"""
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def _drop_dead(self) -> None:
+        while self._heap and not self._heap[0][4]:
+            heapq.heappop(self._heap)
+            self._dead -= 1
+
+    def peek(self):
+        """Returns the earliest deadline, None if nothing is scheduled"""
+        self._drop_dead()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now) -> list:
+        """
+        Unschedules everything whose deadline is at or before `now`
+
+        Returns: list of (key, deadline, payload) tuples, earliest first
+        """
+        due = []
+        self._drop_dead()
+        while self._heap and self._heap[0][0] <= now:
+            when, _, key, payload, _ = heapq.heappop(self._heap)
+            del self._entries[key]
+            due.append((key, when, payload))
+            self._drop_dead()
+        return due